@@ -0,0 +1,943 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import db as dblayer
+
+# Бенчмарки производительности бота. Запуск: python benchmark.py <сценарий> [параметры]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+
+    return f"p50={pick(0.50):.3f} мс  p95={pick(0.95):.3f} мс  p99={pick(0.99):.3f} мс  (n={len(samples)})"
+
+
+def fill_database(path, rows, users=None, migrate=True):
+    # Заполняет базу синтетическими заявками: rows заявок от users пользователей
+    users = users or max(1, rows // 250)
+    conn = sqlite3.connect(path)
+    if migrate:
+        dblayer._init_schema(conn)
+    else:
+        _create_legacy_schema(conn)
+    conn.executemany(
+        "INSERT INTO users (telegram_id, full_name, last_update) VALUES (?, ?, ?)",
+        ((1000 + i, f"Пользователь{i} И.И.", "2024-01-01") for i in range(users)))
+    start = date(2020, 1, 1)
+    days_per_user = max(1, rows // users)
+
+    def generate():
+        for n in range(rows):
+            user_id = n % users + 1
+            meal_date = start + timedelta(days=n // users % (days_per_user + 1))
+            yield (user_id, meal_date.isoformat(), "2024-01-01", "10:00:00", random.choice(["Центр", "Ястреб"]))
+
+    conn.executemany(
+        "INSERT OR IGNORE INTO requests (user_id, meal_date, submission_date, submission_time, canteen) VALUES (?, ?, ?, ?, ?)",
+        generate())
+    conn.commit()
+    conn.close()
+    return users
+
+
+def _create_legacy_schema(conn):
+    # Исходная схема без индексов и миграций - для сравнения
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, telegram_id INTEGER UNIQUE, full_name TEXT, last_update DATE)")
+    conn.execute("CREATE TABLE requests (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, meal_date DATE, "
+                 "submission_date DATE, submission_time TIME, canteen TEXT)")
+
+
+def _legacy_submit(conn, user_id, meal_date, canteen):
+    # Прежний путь: SELECT, затем UPDATE или INSERT (полный просмотр таблицы)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM requests WHERE user_id = ? AND meal_date = ?", (user_id, meal_date))
+    existing = cursor.fetchone()
+    if existing:
+        cursor.execute("UPDATE requests SET canteen = ?, submission_date = ?, submission_time = ? WHERE id = ?",
+                       (canteen, "2024-01-02", "11:00:00", existing[0]))
+    else:
+        cursor.execute("INSERT INTO requests (user_id, meal_date, submission_date, submission_time, canteen) VALUES (?, ?, ?, ?, ?)",
+                       (user_id, meal_date, "2024-01-02", "11:00:00", canteen))
+    conn.commit()
+
+
+# ================= Сценарий: подача заявки =================
+
+def bench_submit(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, migrate in (("старый SELECT + UPDATE/INSERT без индекса", False), ("UPSERT по уникальному индексу", True)):
+            path = os.path.join(tmp, f"submit_{migrate}.db")
+            started = time.perf_counter()
+            users = fill_database(path, args.rows, migrate=migrate)
+            print(f"База на {args.rows} заявок заполнена за {time.perf_counter() - started:.1f} с")
+
+            samples = []
+            if migrate:
+                database = dblayer.Database(path)
+
+                async def run():
+                    for _ in range(args.iterations):
+                        user_id = random.randint(1, users)
+                        meal_date = (date(2030, 1, 1) + timedelta(days=random.randint(0, 30))).isoformat()
+                        t0 = time.perf_counter()
+                        await database.upsert_request(user_id, meal_date, "Центр", "2024-01-02", "11:00:00")
+                        samples.append(time.perf_counter() - t0)
+
+                asyncio.run(run())
+                database.close()
+            else:
+                conn = sqlite3.connect(path)
+                for _ in range(args.iterations):
+                    user_id = random.randint(1, users)
+                    meal_date = (date(2030, 1, 1) + timedelta(days=random.randint(0, 30))).isoformat()
+                    t0 = time.perf_counter()
+                    _legacy_submit(conn, user_id, meal_date, "Центр")
+                    samples.append(time.perf_counter() - t0)
+                conn.close()
+            print(f"{label}: {percentiles(samples)}")
+
+
+# ================= Сценарий: архивация =================
+
+def bench_archive(args):
+    # Архивация старых заявок, пока другие запросы продолжают идти в базу
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "hot.db")
+        users = fill_database(path, args.rows)
+        database = dblayer.Database(path, os.path.join(tmp, "archive.db"))
+        database.init_schema()
+
+        def hot_count(conn):
+            return conn.execute("SELECT COUNT(*) FROM main.requests").fetchone()[0]
+
+        def last_meal_date(conn):
+            return conn.execute("SELECT MAX(meal_date) FROM main.requests").fetchone()[0]
+
+        async def run():
+            before = await database.run(hot_count)
+            t0 = time.perf_counter()
+            await database.run(hot_count)
+            full_scan_before = time.perf_counter() - t0
+
+            samples = []
+            done = asyncio.Event()
+
+            async def submit():
+                while not done.is_set():
+                    user_id = random.randint(1, users)
+                    t = time.perf_counter()
+                    await database.upsert_request(user_id, "2030-01-01", "Центр", "2024-01-02", "11:00:00")
+                    samples.append(time.perf_counter() - t)
+
+            submitter = asyncio.create_task(submit())
+            started = time.perf_counter()
+            last_day = await database.run(last_meal_date)
+            moved = await database.archive_requests(date.fromisoformat(last_day) - timedelta(days=7))
+            elapsed = time.perf_counter() - started
+            done.set()
+            await submitter
+
+            t0 = time.perf_counter()
+            after = await database.run(hot_count)
+            full_scan_after = time.perf_counter() - t0
+            stats = await database.count_stats(history=True)
+            print(f"Перенесено {moved} из {before} заявок за {elapsed:.1f} с, в рабочей таблице осталось {after}")
+            print(f"Всего заявок с архивом: {stats['requests']}")
+            print(f"COUNT(*) по рабочей таблице: {full_scan_before * 1000:.1f} мс -> {full_scan_after * 1000:.1f} мс")
+            print(f"Подача заявки во время архивации: {percentiles(samples)}")
+
+        asyncio.run(run())
+        database.close()
+
+
+# ================= Сценарий: выгрузка во время подачи заявок =================
+
+def bench_wal(args):
+    from export import take_snapshot, write_excel
+
+    def export_live(path, target):
+        return write_excel(path, target)
+
+    def export_snapshot(path, target):
+        # Чтение рабочей базы длится только время копирования
+        t0 = time.perf_counter()
+        snapshot = take_snapshot(path, folder=os.path.dirname(target))
+        print(f"  снимок базы снят за {(time.perf_counter() - t0) * 1000:.0f} мс")
+        try:
+            return write_excel(snapshot.path, target)
+        finally:
+            snapshot.close()
+
+    variants = (("DELETE", "DELETE", export_live), ("WAL", "WAL", export_live), ("WAL + снимок", "WAL", export_snapshot))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n, (label, mode, exporter) in enumerate(variants):
+            path = os.path.join(tmp, f"wal_{n}.db")
+            users = fill_database(path, args.rows)
+            database = dblayer.Database(path, journal_mode=mode)
+            database.init_schema()
+            checkpoints = dblayer.CheckpointManager(database, interval=1.0)
+
+            async def run():
+                checkpoints.start()
+                samples = []
+                errors = 0
+                wal_max = 0
+                export = asyncio.create_task(
+                    asyncio.to_thread(exporter, path, os.path.join(tmp, f"export_{n}.xlsx")))
+                started = time.perf_counter()
+                while not export.done():
+                    user_id = random.randint(1, users)
+                    meal_date = (date(2030, 1, 1) + timedelta(days=random.randint(0, 30))).isoformat()
+                    t0 = time.perf_counter()
+                    try:
+                        await database.upsert_request(user_id, meal_date, "Центр", "2024-01-02", "11:00:00")
+                        samples.append(time.perf_counter() - t0)
+                    except sqlite3.OperationalError:
+                        # Писатель прождал BUSY_TIMEOUT и не дождался конца чтения
+                        errors += 1
+                    wal_max = max(wal_max, database.wal_size())
+                    await asyncio.sleep(0.005)
+                written = await export
+                elapsed = time.perf_counter() - started
+                await checkpoints.close()
+                print(f"{label}: выгрузка {written} строк за {elapsed:.1f} с, заявок подано {len(samples)}, "
+                      f"ошибок 'database is locked' {errors}")
+                if mode == "WAL":
+                    print(f"  WAL во время выгрузки до {wal_max // 1024} КБ, после остановки {database.wal_size() // 1024} КБ")
+                if samples:
+                    print(f"  подача заявки во время выгрузки: {percentiles(samples)}")
+
+            asyncio.run(run())
+            database.close()
+
+
+# ================= Сценарий: форматы выгрузки =================
+
+def bench_formats(args):
+    from openpyxl import Workbook
+
+    import export
+    from export import write_csv_gz, write_excel, write_jsonl_gz
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "formats.db")
+        fill_database(path, args.rows)
+        database = dblayer.Database(path)
+        database.init_schema()
+        database.close()
+
+        def xlsx():
+            target = os.path.join(tmp, "export.xlsx")
+            written = write_excel(path, target)
+            return written, os.path.getsize(target)
+
+        def gz(writer):
+            def run():
+                data, written = writer(path)
+                return written, len(data)
+            return run
+
+        for label, run_export in (("xlsx (openpyxl)", xlsx), ("csv.gz", gz(write_csv_gz)), ("jsonl.gz", gz(write_jsonl_gz))):
+            started = time.perf_counter()
+            written, size = run_export()
+            elapsed = time.perf_counter() - started
+            print(f"{label}: {written} строк за {elapsed:.1f} с ({written / elapsed:,.0f} строк/с), "
+                  f"{size / (1024 * 1024):.1f} МБ")
+
+        # Лист сводки xlsx отдельно: GROUP BY по индексу вместо чтения всех заявок
+        conn, requests, params = export._connect(path)
+        workbook = Workbook(write_only=True)
+        started = time.perf_counter()
+        days = export._write_summary(workbook, conn, requests, params)
+        print(f"лист сводки: {days} дней за {(time.perf_counter() - started) * 1000:.0f} мс")
+        workbook.save(os.path.join(tmp, "summary.xlsx"))
+        conn.close()
+
+
+# ================= Сценарий: выгрузка с фильтром =================
+
+def bench_filtered(args):
+    # Выгрузка так же, как в обработчике: снимок базы администратора, затем CSV.gz по снимку.
+    # Старые заявки лежат в архиве; его копирует только выгрузка с историей.
+    from export import ExportFilter, SnapshotRegistry, write_csv_gz
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "filtered.db")
+        fill_database(path, args.rows)
+        database = dblayer.Database(path, os.path.join(tmp, "archive.db"))
+        database.init_schema()
+
+        conn = sqlite3.connect(path)
+        last_day = date.fromisoformat(conn.execute("SELECT MAX(meal_date) FROM requests").fetchone()[0])
+        conn.close()
+        selections = (
+            ("один день, одна столовая", False, ExportFilter(last_day, last_day, "Центр")),
+            ("неделя", False, ExportFilter(last_day - timedelta(days=6), last_day)),
+            ("месяц", False, ExportFilter(last_day - timedelta(days=30), last_day)),
+            ("всё время (с архивом)", True, ExportFilter()),
+        )
+
+        async def run():
+            await database.archive_requests(last_day - timedelta(days=31))
+            database.close()
+            registry = SnapshotRegistry(path, database.archive_name, folder=tmp)
+            for label, history, selection in selections:
+                snapshot_samples = []
+                export_samples = []
+                for _ in range(3):
+                    t0 = time.perf_counter()
+                    # fresh=True - как первый отчет в новой сессии администратора
+                    async with registry.use(0, history, fresh=True) as snapshot:
+                        t1 = time.perf_counter()
+                        archive_name = snapshot.archive_path if history else None
+                        _, written = await asyncio.to_thread(
+                            write_csv_gz, snapshot.path, None, archive_name, selection)
+                        t2 = time.perf_counter()
+                    snapshot_samples.append(t1 - t0)
+                    export_samples.append(t2 - t1)
+                print(f"{label}: {written} строк, снимок {min(snapshot_samples) * 1000:.1f} мс, "
+                      f"выгрузка {min(export_samples) * 1000:.1f} мс")
+            registry.close()
+
+        asyncio.run(run())
+
+
+def bench_manifest(args):
+    # Список для кухни: полное построение на отсечке против дельты от поздней заявки
+    from export import ExportFilter, write_excel
+    from keyboards import CANTEENS
+    from manifest import ManifestRegistry
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "manifest.db")
+        fill_database(path, args.rows, args.users)
+        database = dblayer.Database(path)
+        database.init_schema()
+        registry = ManifestRegistry(database, CANTEENS)
+
+        conn = sqlite3.connect(path)
+        last_day = date.fromisoformat(conn.execute("SELECT MAX(meal_date) FROM requests").fetchone()[0])
+        conn.close()
+
+        async def run():
+            samples = []
+            for _ in range(10):
+                t0 = time.perf_counter()
+                manifest = await registry.build(last_day)
+                manifest.render()
+                samples.append(time.perf_counter() - t0)
+            print(f"построение на отсечке ({len(manifest.entries)} заявок, "
+                  f"{len(manifest.render())} сообщ.): {percentiles(samples)}")
+
+            user_ids = list(manifest.entries)
+            samples = []
+            for n in range(args.iterations):
+                user_id = random.choice(user_ids)
+                t0 = time.perf_counter()
+                registry.apply(last_day, user_id, manifest.entries[user_id][0], CANTEENS[n % len(CANTEENS)])
+                manifest.render()
+                samples.append(time.perf_counter() - t0)
+            print(f"дельта + повторная отрисовка: {percentiles(samples)}")
+
+        asyncio.run(run())
+        database.close()
+
+        # Для сравнения: выгрузка того же дня в Excel, как делалось без списка
+        t0 = time.perf_counter()
+        write_excel(path, os.path.join(tmp, "day.xlsx"), export_filter=ExportFilter(last_day, last_day))
+        print(f"выгрузка дня в Excel: {(time.perf_counter() - t0) * 1000:.1f} мс")
+
+
+# ================= Сценарий: хранилище FSM =================
+
+def bench_fsm(args):
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from storage import SQLiteStorage
+
+    async def run(storage, label):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        if isinstance(storage, SQLiteStorage):
+            storage.start()
+        write_samples = []
+        read_samples = []
+        for n in range(args.sessions):
+            key = StorageKey(bot_id=1, chat_id=n, user_id=n)
+            t0 = time.perf_counter()
+            await storage.set_state(key, "Form:waiting_for_canteen")
+            await storage.update_data(key, {"user_id": n, "full_name": "Иванов И.И.", "meal_date": "2030-01-01"})
+            write_samples.append(time.perf_counter() - t0)
+        if isinstance(storage, SQLiteStorage):
+            await storage.flush()
+        for _ in range(args.iterations):
+            n = random.randrange(args.sessions)
+            key = StorageKey(bot_id=1, chat_id=n, user_id=n)
+            t0 = time.perf_counter()
+            await storage.get_state(key)
+            await storage.get_data(key)
+            read_samples.append(time.perf_counter() - t0)
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        await storage.close()
+        print(f"{label}: память {memory / 1024 / 1024:.1f} МБ на {args.sessions} сессий")
+        print(f"  запись состояния и данных: {percentiles(write_samples)}")
+        print(f"  чтение состояния и данных: {percentiles(read_samples)}")
+
+    asyncio.run(run(MemoryStorage(), "MemoryStorage"))
+    with tempfile.TemporaryDirectory() as tmp:
+        database = dblayer.Database(os.path.join(tmp, "fsm.db"))
+        database.init_schema()
+        asyncio.run(run(SQLiteStorage(database), "SQLiteStorage"))
+        database.close()
+
+
+# ================= Локальный фейковый Telegram =================
+
+FAKE_TOKEN = "123456:TEST-TOKEN"
+
+
+def make_message_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        },
+    }
+
+
+# Локальный сервер Bot API: отдает обновления через getUpdates и фиксирует ответы бота
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.sent = []
+        self._new_update = asyncio.Event()
+        self._waiters = {}
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def make_bot(self):
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{self.port}"))
+        return Bot(token=FAKE_TOKEN, session=session)
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self._new_update.set()
+
+    def wait_reply(self, chat_id):
+        # Future, который завершится при следующем ответе бота в чат chat_id
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    async def _handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Бенчмарк", "username": "bench_bot"}
+        elif method == "getupdates":
+            result = await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif method in ("sendmessage", "senddocument", "editmessagetext"):
+            chat_id = int(params.get("chat_id") or 0)
+            self.sent.append((chat_id, method, time.perf_counter()))
+            for future in self._waiters.pop(chat_id, []):
+                if not future.done():
+                    future.set_result(time.perf_counter())
+            result = {"message_id": len(self.sent), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, offset, timeout):
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+
+# ================= Сценарий: polling против webhook =================
+
+def bench_ingest(args):
+    from aiogram import Dispatcher, types
+    from webhook import WebhookServer
+
+    async def run():
+        fake = FakeTelegram()
+        await fake.start()
+        bot = fake.make_bot()
+        dp = Dispatcher()
+
+        @dp.message()
+        async def echo(message: types.Message):
+            await message.answer(message.text)
+
+        # Polling
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=10))
+        await asyncio.sleep(0.2)
+        samples = []
+        for n in range(args.iterations):
+            reply = fake.wait_reply(1000 + n)
+            t0 = time.perf_counter()
+            fake.push_update(make_message_update(n + 1, 1000 + n, "ping"))
+            samples.append(await reply - t0)
+        print(f"polling: {percentiles(samples)}")
+        await dp.stop_polling()
+        await polling
+
+        # Webhook: фейковый Telegram отправляет обновления POST-запросами
+        import aiohttp
+
+        server = WebhookServer(dp, bot, secret_token="bench-secret")
+        await server.start("127.0.0.1", args.port)
+        url = f"http://127.0.0.1:{args.port}{server.path}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}
+        samples = []
+        async with aiohttp.ClientSession() as http:
+            for n in range(args.iterations):
+                reply = fake.wait_reply(1000 + n)
+                t0 = time.perf_counter()
+                async with http.post(url, json=make_message_update(100000 + n, 1000 + n, "ping"), headers=headers) as response:
+                    assert response.status == 200, response.status
+                samples.append(await reply - t0)
+            async with http.post(url, json={}, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                assert response.status == 401, response.status
+        print(f"webhook: {percentiles(samples)}")
+
+        await server.stop()
+        await bot.session.close()
+        await fake.stop()
+
+    asyncio.run(run())
+
+
+# ================= Сценарий: нагрузка на обработчики bot.py =================
+
+def make_fake_session():
+    # Сессия Bot API без сети: запросы бота сразу получают правдоподобный ответ
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Message
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls += 1
+            name = type(method).__name__
+            if name in ("SendMessage", "SendDocument"):
+                data = {
+                    "message_id": self.calls,
+                    "date": int(time.time()),
+                    "chat": {"id": method.chat_id, "type": "private"},
+                    "text": getattr(method, "text", None),
+                }
+                if name == "SendDocument":
+                    data["document"] = {"file_id": f"file-{self.calls}", "file_unique_id": f"u{self.calls}"}
+                return Message.model_validate(data, context={"bot": bot})
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+def make_callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "план",
+            },
+        },
+    }
+
+
+@contextlib.contextmanager
+def offline_bot():
+    # Импортирует bot.py во временном каталоге (там создаются база и папка отчетов)
+    # и отдает модуль вместе с ботом на фейковой сессии
+    import importlib
+    import logging
+    import sys
+
+    from aiogram import Bot
+
+    # Журнал обработчиков не должен искажать замеры
+    logging.disable(logging.INFO)
+    workdir = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    bot_module = importlib.import_module("bot")
+    try:
+        yield bot_module, Bot(token=FAKE_TOKEN, session=make_fake_session())
+    finally:
+        bot_module.snapshots.close()
+        bot_module.db.close()
+        os.chdir(workdir)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_load(args):
+    from aiogram.types import Update
+
+    from keyboards import ExportCallback
+
+    meal_date = (date.today() + timedelta(days=1)).strftime("%d.%m.%Y")
+    samples = {}
+    counter = iter(range(1, 10 ** 9))
+
+    with offline_bot() as (bot_module, fake_bot):
+        async def feed(label, user_id, text=None, callback_data=None):
+            if callback_data is None:
+                payload = make_message_update(next(counter), user_id, text)
+            else:
+                payload = make_callback_update(next(counter), user_id, callback_data)
+            update = Update.model_validate(payload, context={"bot": fake_bot})
+            t0 = time.perf_counter()
+            await bot_module.dp.feed_update(fake_bot, update)
+            samples.setdefault(label, []).append(time.perf_counter() - t0)
+
+        async def user_flow(user_id):
+            await feed("регистрация", user_id, "/start")
+            await feed("регистрация", user_id, "Иванов И.И.")
+            await feed("заявка", user_id, "🍽 Подать заявку")
+            await feed("заявка", user_id, meal_date)
+            await feed("заявка", user_id, random.choice(["Центр", "Ястреб"]))
+
+        async def admin_flow():
+            await feed("статистика", bot_module.ADMIN_ID, "📊 Статистика")
+            await feed("экспорт", bot_module.ADMIN_ID, "📥 Экспорт в Excel")
+            await feed("экспорт", bot_module.ADMIN_ID, callback_data=ExportCallback(action="go", fmt="xlsx").pack())
+
+        async def run():
+            await bot_module.warm_up()
+            bot_module.fsm_storage.start()
+            await bot_module.user_registry.save(bot_module.ADMIN_ID, "Админов А.А.", date.today())
+            started = time.perf_counter()
+            for first in range(0, args.users, args.concurrency):
+                batch = range(first, min(first + args.concurrency, args.users))
+                await asyncio.gather(*(user_flow(100000 + n) for n in batch), admin_flow())
+            elapsed = time.perf_counter() - started
+            await bot_module.fsm_storage.close()
+
+            total = sum(len(v) for v in samples.values())
+            print(f"Обновлений: {total} за {elapsed:.2f} с, {total / elapsed:.0f} обновлений/с")
+            for label, values in samples.items():
+                print(f"  {label}: {percentiles(values)}")
+
+        asyncio.run(run())
+
+
+# ================= Сценарий: заявки на неделю =================
+
+def db_writes(metrics):
+    # Пишущие транзакции с заявками по счетчикам метрик БД
+    lines = metrics.DB_QUERY_SECONDS.render()
+    total = 0
+    for name in ("upsert_request", "save_week_plan"):
+        for line in lines:
+            if line.startswith(f'bot_db_query_seconds_count{{query="{name}"}}'):
+                total += int(line.rsplit(" ", 1)[1])
+    return total
+
+
+def bench_week(args):
+    from aiogram.types import Update
+
+    import metrics
+    from keyboards import PlanCallback, plan_dates
+
+    counter = iter(range(1, 10 ** 9))
+    with offline_bot() as (bot_module, fake_bot):
+        async def feed(payload):
+            update = Update.model_validate(payload, context={"bot": fake_bot})
+            await bot_module.dp.feed_update(fake_bot, update)
+
+        async def measure(label, flow, user_id):
+            updates_before, calls_before, writes_before = next(counter), fake_bot.session.calls, db_writes(metrics)
+            await flow(user_id)
+            updates = next(counter) - updates_before - 1
+            print(f"{label}: {updates} обновлений от пользователя, "
+                  f"{fake_bot.session.calls - calls_before} вызовов Bot API, "
+                  f"{db_writes(metrics) - writes_before} пишущих транзакций")
+
+        async def daily_flow(user_id):
+            for d in plan_dates():
+                await feed(make_message_update(next(counter), user_id, "🍽 Подать заявку"))
+                await feed(make_message_update(next(counter), user_id, d.strftime("%d.%m.%Y")))
+                await feed(make_message_update(next(counter), user_id, "Центр"))
+
+        async def planner_flow(user_id):
+            await feed(make_message_update(next(counter), user_id, "📅 План на неделю"))
+            for d in plan_dates():
+                data = PlanCallback(action="set", day=d.isoformat(), canteen=0).pack()
+                await feed(make_callback_update(next(counter), user_id, data))
+            await feed(make_callback_update(next(counter), user_id, PlanCallback(action="save").pack()))
+
+        async def weekdays_flow(user_id):
+            # Одна столовая на все будни: открыть план и нажать столовую в строке «Все будни»
+            await feed(make_message_update(next(counter), user_id, "📅 План на неделю"))
+            data = PlanCallback(action="weekdays", canteen=0).pack()
+            await feed(make_callback_update(next(counter), user_id, data))
+
+        async def run():
+            await bot_module.warm_up()
+            # Синтетические пользователи жмут быстрее живых - ограничитель их не касается
+            bot_module.throttle.exempt.update({1, 2, 3})
+            flows = ((1, daily_flow, "по одному дню"), (2, planner_flow, "план на неделю"),
+                     (3, weekdays_flow, "все будни одним нажатием"))
+            for user_id, flow, label in flows:
+                await bot_module.user_registry.save(user_id, "Иванов И.И.", date.today())
+                await measure(label, flow, user_id)
+            await bot_module.fsm_storage.close()
+
+        asyncio.run(run())
+
+
+def bench_throttle(args):
+    # Пользователи-"долбилы": каждое нажатие в потоке заявки приходит пачкой из повторов
+    from aiogram.types import Update
+
+    import metrics
+
+    meal_date = (date.today() + timedelta(days=1)).strftime("%d.%m.%Y")
+    counter = iter(range(1, 10 ** 9))
+    taps = 5
+
+    with offline_bot() as (bot_module, fake_bot):
+        async def feed(user_id, text):
+            update = Update.model_validate(make_message_update(next(counter), user_id, text), context={"bot": fake_bot})
+            await bot_module.dp.feed_update(fake_bot, update)
+
+        async def hammer(user_id):
+            for text in ("🍽 Подать заявку", meal_date, "Центр"):
+                await asyncio.gather(*(feed(user_id, text) for _ in range(taps)))
+
+        def handled():
+            return sum(int(line.rsplit(" ", 1)[1]) for line in metrics.UPDATE_SECONDS.render()
+                       if line.startswith("bot_update_seconds_count"))
+
+        async def measure(label, first_user, exempt):
+            users = range(first_user, first_user + args.users)
+            for user_id in users:
+                await bot_module.user_registry.save(user_id, "Иванов И.И.", date.today())
+            if exempt:
+                bot_module.throttle.exempt.update(users)
+            handled_before, calls_before, writes_before = handled(), fake_bot.session.calls, db_writes(metrics)
+            started = time.perf_counter()
+            for first in range(0, args.users, args.concurrency):
+                await asyncio.gather(*(hammer(user_id) for user_id in users[first:first + args.concurrency]))
+            elapsed = time.perf_counter() - started
+            print(f"{label}: {args.users * taps * 3} обновлений за {elapsed:.2f} с, "
+                  f"до обработчиков дошло {handled() - handled_before}, "
+                  f"вызовов Bot API {fake_bot.session.calls - calls_before}, "
+                  f"записей заявок {db_writes(metrics) - writes_before}")
+
+        async def run():
+            await bot_module.warm_up()
+            await measure("без ограничителя", 100000, exempt=True)
+            await measure("с ограничителем", 200000, exempt=False)
+            print("\n".join(line for line in metrics.THROTTLED_UPDATES.render() if not line.startswith("#")))
+            await bot_module.fsm_storage.close()
+
+        asyncio.run(run())
+
+
+def bench_workers(args):
+    # Бот запускается отдельным процессом (с воркерами и без) против фейкового Telegram в этом процессе.
+    # Пользователи одновременно проходят регистрацию и подачу заявки, каждый шаг ждет ответа бота.
+    import subprocess
+    import sys
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    meal_date = (date.today() + timedelta(days=1)).strftime("%d.%m.%Y")
+    flow = ("/start", "Иванов И.И.", "🍽 Подать заявку", meal_date, "Центр")
+    counter = iter(range(1, 10 ** 9))
+
+    async def measure(workers):
+        fake = FakeTelegram()
+        await fake.start()
+        with tempfile.TemporaryDirectory() as tmp:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, script, "--workers", str(workers),
+                "--api-server", f"http://127.0.0.1:{fake.port}", "--send-rate", "1000000",
+                "--metrics-port", "0",
+                cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                # Бот готов, когда ответил на первое сообщение
+                ready = fake.wait_reply(1)
+                fake.push_update(make_message_update(next(counter), 1, "/start"))
+                await asyncio.wait_for(ready, 120)
+
+                samples = []
+
+                async def user_flow(user_id):
+                    for text in flow:
+                        reply = fake.wait_reply(user_id)
+                        t0 = time.perf_counter()
+                        fake.push_update(make_message_update(next(counter), user_id, text))
+                        samples.append(await reply - t0)
+
+                started = time.perf_counter()
+                await asyncio.gather(*(user_flow(100000 + n) for n in range(args.users)))
+                elapsed = time.perf_counter() - started
+                print(f"воркеров {workers}: {len(samples)} обновлений за {elapsed:.2f} с, "
+                      f"{len(samples) / elapsed:.0f} обновлений/с; ответ: {percentiles(samples)}")
+            finally:
+                process.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(process.wait(), 60)
+                except asyncio.TimeoutError:
+                    process.kill()
+                await fake.stop()
+
+    async def run():
+        for workers in (1, 2, 4):
+            await measure(workers)
+
+    asyncio.run(run())
+
+
+# ================= Сценарий: холодный запуск =================
+
+STARTUP_CHILD = """
+import asyncio, json, sys, time
+started = time.time()
+sys.path.insert(0, {root!r})
+import benchmark
+import bot
+imported = time.time()
+
+async def run():
+    from aiogram import Bot
+    from aiogram.types import Update
+
+    await bot.warm_up()
+    warmed = time.time()
+    fake_bot = Bot(token=benchmark.FAKE_TOKEN, session=benchmark.make_fake_session())
+    update = Update.model_validate(benchmark.make_message_update(1, 100, "/start"), context={{"bot": fake_bot}})
+    await bot.dp.feed_update(fake_bot, update)
+    first_update = time.time()
+    modules = [name for name in ("openpyxl", "apscheduler") if name in sys.modules]
+    print(json.dumps({{"started": started, "imported": imported, "warmed": warmed,
+                      "first_update": first_update, "heavy_modules": modules}}))
+
+asyncio.run(run())
+bot.db.close()
+"""
+
+
+def bench_startup(args):
+    import json
+    import subprocess
+    import sys
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            spawned = time.time()
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_CHILD.format(root=root)],
+                cwd=tmp, capture_output=True, text=True, check=True).stdout
+            results.append((spawned, json.loads(output.strip().splitlines()[-1])))
+
+    def report(label, values):
+        values = sorted(values)
+        print(f"{label}: медиана {values[len(values) // 2] * 1000:.0f} мс, мин {values[0] * 1000:.0f} мс")
+
+    report("запуск интерпретатора", [r["started"] - spawned for spawned, r in results])
+    report("импорт bot.py", [r["imported"] - r["started"] for _, r in results])
+    report("прогрев", [r["warmed"] - r["imported"] for _, r in results])
+    report("время до первого обновления", [r["first_update"] - spawned for spawned, r in results])
+    print(f"Тяжелые модули, загруженные к первому обновлению: {results[-1][1]['heavy_modules'] or 'нет'}")
+
+
+SCENARIOS = {
+    "submit": bench_submit,
+    "fsm": bench_fsm,
+    "ingest": bench_ingest,
+    "load": bench_load,
+    "startup": bench_startup,
+    "week": bench_week,
+    "archive": bench_archive,
+    "wal": bench_wal,
+    "formats": bench_formats,
+    "filtered": bench_filtered,
+    "manifest": bench_manifest,
+    "throttle": bench_throttle,
+    "workers": bench_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота заявок на питание")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=1_000_000, help="число заявок в базе")
+    parser.add_argument("--iterations", type=int, default=200, help="число замеров")
+    parser.add_argument("--sessions", type=int, default=50_000, help="число одновременных сессий FSM")
+    parser.add_argument("--port", type=int, default=8081, help="порт локального webhook-сервера")
+    parser.add_argument("--users", type=int, default=2000, help="число синтетических пользователей")
+    parser.add_argument("--runs", type=int, default=5, help="число запусков процесса")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько пользователей действуют одновременно")
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,38 @@
+import argparse
+import asyncio
 import logging
+import multiprocessing
 import os
-import sqlite3
 import re
+import secrets
+import signal
+import time
 from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-import calendar
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.types import ReplyKeyboardRemove
+from db import CheckpointManager, Database
+from broadcast import Broadcaster
+from export import (
+    ExportCache, ExportFilter, SnapshotRegistry, count_export_rows, prune_reports, write_csv_gz, write_excel, write_jsonl_gz,
+)
+from users import UserRegistry
+from manifest import ManifestRegistry, format_change
+import metrics
+import throttling
+from outbound import GLOBAL_RATE, OutboundQueue, OutboundQueueMiddleware, SharedTokenBucket, TokenBucket
+from keyboards import (
+    main_menu, date_keyboard, plan_dates, week_plan_keyboard, export_keyboard, period_range,
+    PlanCallback, ExportCallback, CANTEEN_KEYBOARD, CANTEENS, EXPORT_FORMATS, BTN_BACK, BTN_WEEK_PLAN, BTN_MANIFEST,
+)
+from storage import SQLiteStorage
+from webhook import WebhookServer, WEBHOOK_PATH, MAX_CONCURRENCY, MAX_BODY_SIZE
+from workers import ShardRouter, WorkerServer, poll_updates
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,56 +47,63 @@ TOKEN = "8041866728:AAGaQGnSE0JR7Oyt8fJg8aV6A_9AWxxXv_E"
 # ID администратора (ваш Telegram ID)
 ADMIN_ID = 189380617
 
-# Инициализация бота и диспетчера
+# Часовой пояс расписаний (напоминания, архивация, список для кухни)
+TIMEZONE = ZoneInfo("Europe/Moscow")
+
+# Отсечка приема заявок на завтра: в это время формируется список для кухни.
+# Изменения после отсечки применяются к готовому списку и рассылаются получателям.
+MANIFEST_DAYS = "mon-fri"
+MANIFEST_CUTOFF_HOUR = 17
+MANIFEST_CUTOFF_MINUTE = 0
+MANIFEST_RECIPIENTS = [ADMIN_ID]
+
+# Инициализация бота: все исходящие сообщения идут через очередь с приоритетами
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
+outbound_queue = OutboundQueue()
+bot.session.middleware(OutboundQueueMiddleware(outbound_queue))
+broadcaster = Broadcaster(bot)
 
 # Настройка базы данных
 DB_NAME = "food_requests.db"
+# Архив заявок: прошедшие дни старше ARCHIVE_AFTER_DAYS переносятся в отдельный файл,
+# в рабочей таблице остается не больше HOT_MAX_ROWS заявок
+ARCHIVE_DB_NAME = "food_requests_archive.db"
+ARCHIVE_AFTER_DAYS = 90
+HOT_MAX_ROWS = 200000
 EXCEL_FOLDER = os.path.join(os.getcwd(), "excel_reports")
 os.makedirs(EXCEL_FOLDER, exist_ok=True)
 logger.info(f"Папка для отчетов: {EXCEL_FOLDER}")
+export_cache = ExportCache()
 
-# Создание таблиц в базе данных
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE,
-        full_name TEXT,
-        last_update DATE
-    )
-    ''')
-    
-    # Таблица заявок (добавлены поля submission_date и submission_time)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        meal_date DATE,          -- Дата питания
-        submission_date DATE,    -- Дата подачи заявки
-        submission_time TIME,    -- Время подачи заявки
-        canteen TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("База данных инициализирована")
+# Единый слой доступа к данным (отдельный поток БД)
+# Схема создается при запуске в warm_up(), а не при импорте модуля
+db = Database(DB_NAME, ARCHIVE_DB_NAME)
+# Фоновые контрольные точки WAL
+checkpoints = CheckpointManager(db)
+# Снимки базы для отчетов: одна копия на сессию администратора
+snapshots = SnapshotRegistry(DB_NAME, ARCHIVE_DB_NAME)
+# Списки для кухни, сформированные на отсечке
+manifests = ManifestRegistry(db, CANTEENS)
+user_registry = UserRegistry(db, ADMIN_ID)
+# Соединение с фронтом, если бот запущен воркером в режиме нескольких процессов
+worker_server = None
 
-# Инициализация базы данных
-init_db()
+# Диспетчер с хранением состояний FSM в базе (переживают перезапуск).
+# Обновления одного пользователя обрабатываются по очереди, чтобы переходы FSM не накладывались
+fsm_storage = SQLiteStorage(db)
+dp = Dispatcher(storage=fsm_storage, events_isolation=SimpleEventIsolation())
+# Ограничение частоты и двойных нажатий на пользователя (администратор не ограничивается)
+throttle = throttling.ThrottlingMiddleware(exempt={ADMIN_ID})
+throttling.setup(dp, throttle)
+metrics.setup(dp, bot)
 
 # Состояния для FSM
 class Form(StatesGroup):
     waiting_for_name = State()
     waiting_for_meal_date = State()
     waiting_for_canteen = State()
+    planning_week = State()
+    waiting_for_export_range = State()
 
 # ================= Обработчики команд =================
 
@@ -87,17 +113,13 @@ async def cmd_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Проверяем, есть ли пользователь в базе
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT full_name FROM users WHERE telegram_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user = await user_registry.get(user_id)
     
     if user:
         await message.answer(
-            f"С возвращением, {user[0]}!\n"
+            f"С возвращением, {user[1]}!\n"
             "Используйте кнопки меню для работы с ботом.",
-            reply_markup=create_main_menu(user_id == ADMIN_ID))
+            reply_markup=main_menu(user[2]))
         await state.clear()
     else:
         await message.answer(
@@ -108,21 +130,6 @@ async def cmd_start(message: types.Message, state: FSMContext):
         )
         await state.set_state(Form.waiting_for_name)
 
-# Создание главного меню
-def create_main_menu(is_admin=False):
-    builder = ReplyKeyboardBuilder()
-    builder.add(KeyboardButton(text="🍽 Подать заявку"))
-    builder.add(KeyboardButton(text="✏️ Изменить ФИО"))
-    builder.add(KeyboardButton(text="❌ Удалить мои данные"))
-    
-    if is_admin:
-        builder.add(KeyboardButton(text="📊 Статистика"))
-        builder.add(KeyboardButton(text="📥 Экспорт в Excel"))
-        builder.add(KeyboardButton(text="🧹 Очистить базу"))
-    
-    builder.adjust(2, 2, 2)
-    return builder.as_markup(resize_keyboard=True)
-
 # Обработчик ввода ФИО (с проверкой формата)
 @dp.message(Form.waiting_for_name)
 async def process_name(message: types.Message, state: FSMContext):
@@ -141,37 +148,19 @@ async def process_name(message: types.Message, state: FSMContext):
         return
     
     # Сохраняем в базу данных
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
     try:
-        # Проверяем существование пользователя
-        cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if user:
-            # Обновляем существующего пользователя
-            cursor.execute(
-                "UPDATE users SET full_name = ?, last_update = ? WHERE telegram_id = ?",
-                (full_name, today, user_id))
-        else:
-            # Добавляем нового пользователя
-            cursor.execute(
-                "INSERT INTO users (telegram_id, full_name, last_update) VALUES (?, ?, ?)",
-                (user_id, full_name, today))
-        
-        conn.commit()
+        user_id_db = await user_registry.save(user_id, full_name, today)
+        manifests.rename(user_id_db, full_name)
         await message.answer(
             f"✅ Спасибо, {full_name}! Ваше ФИО сохранено.\n"
             "Теперь вы можете подать заявку на питание с помощью кнопки меню.",
-            reply_markup=create_main_menu(user_id == ADMIN_ID)
+            reply_markup=main_menu(user_id == ADMIN_ID)
         )
         logger.info(f"Пользователь {user_id} сохранен: {full_name}")
     except Exception as e:
         logger.error(f"Ошибка при сохранении ФИО: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при сохранении данных. Попробуйте еще раз.")
     finally:
-        conn.close()
         await state.clear()
 
 # Обработчик кнопки "Изменить ФИО"
@@ -189,33 +178,16 @@ async def order_handler(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Проверяем, зарегистрирован ли пользователь
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, full_name FROM users WHERE telegram_id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    user = await user_registry.get(user_id)
     
     if not user:
         await message.answer("Пожалуйста, сначала зарегистрируйтесь с помощью команды /start.")
         return
     
-    # Создаем клавиатуру с датами (завтра, послезавтра, через 2 дня)
-    today = date.today()
-    dates = [
-        today + timedelta(days=1),
-        today + timedelta(days=2),
-        today + timedelta(days=3)
-    ]
-    
-    builder = ReplyKeyboardBuilder()
-    for d in dates:
-        builder.add(KeyboardButton(text=d.strftime("%d.%m.%Y")))
-    builder.add(KeyboardButton(text="↩️ Назад"))
-    builder.adjust(3, 1)
-    
+    # Клавиатура с датами (завтра, послезавтра, через 2 дня)
     await message.answer(
         f"{user[1]}, выберите дату питания:",
-        reply_markup=builder.as_markup(resize_keyboard=True))
+        reply_markup=date_keyboard())
     
     # Сохраняем user_id в контексте
     await state.update_data(user_id=user[0], full_name=user[1])
@@ -226,8 +198,8 @@ async def order_handler(message: types.Message, state: FSMContext):
 @dp.message(Form.waiting_for_meal_date)
 async def process_meal_date(message: types.Message, state: FSMContext):
     # Обработка кнопки "Назад"
-    if message.text == "↩️ Назад":
-        await message.answer("Главное меню:", reply_markup=create_main_menu(message.from_user.id == ADMIN_ID))
+    if message.text == BTN_BACK:
+        await message.answer("Главное меню:", reply_markup=main_menu(message.from_user.id == ADMIN_ID))
         await state.clear()
         return
     
@@ -257,18 +229,11 @@ async def process_meal_date(message: types.Message, state: FSMContext):
         return
     
     # Сохраняем дату в контексте
-    await state.update_data(meal_date=meal_date)
-    
-    # Создаем клавиатуру с выбором столовой
-    builder = ReplyKeyboardBuilder()
-    builder.add(KeyboardButton(text="Центр"))
-    builder.add(KeyboardButton(text="Ястреб"))
-    builder.add(KeyboardButton(text="↩️ Назад"))
-    builder.adjust(2, 1)
+    await state.update_data(meal_date=meal_date.isoformat())
     
     await message.answer(
         f"✅ Вы выбрали дату: {meal_date.strftime('%d.%m.%Y')}\nТеперь выберите столовую:",
-        reply_markup=builder.as_markup(resize_keyboard=True))
+        reply_markup=CANTEEN_KEYBOARD)
     
     await state.set_state(Form.waiting_for_canteen)
 
@@ -276,33 +241,19 @@ async def process_meal_date(message: types.Message, state: FSMContext):
 @dp.message(Form.waiting_for_canteen)
 async def process_canteen(message: types.Message, state: FSMContext):
     # Обработка кнопки "Назад"
-    if message.text == "↩️ Назад":
+    if message.text == BTN_BACK:
         # Возвращаемся к выбору даты
         user_data = await state.get_data()
         full_name = user_data.get('full_name', 'пользователь')
         
-        # Создаем клавиатуру с датами
-        today = date.today()
-        dates = [
-            today + timedelta(days=1),
-            today + timedelta(days=2),
-            today + timedelta(days=3)
-        ]
-        
-        builder = ReplyKeyboardBuilder()
-        for d in dates:
-            builder.add(KeyboardButton(text=d.strftime("%d.%m.%Y")))
-        builder.add(KeyboardButton(text="↩️ Назад"))
-        builder.adjust(3, 1)
-        
         await message.answer(
             f"{full_name}, выберите дату питания:",
-            reply_markup=builder.as_markup(resize_keyboard=True))
+            reply_markup=date_keyboard())
         await state.set_state(Form.waiting_for_meal_date)
         return
     
     # Проверяем, что выбрана столовая
-    if message.text not in ["Центр", "Ястреб"]:
+    if message.text not in CANTEENS:
         await message.answer("❌ Пожалуйста, выберите столовую из предложенных вариантов.")
         return
     
@@ -319,6 +270,7 @@ async def process_canteen(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка: данные сессии утеряны. Начните заново.")
         await state.clear()
         return
+    meal_date = date.fromisoformat(meal_date)
     
     # Фиксируем дату и время подачи заявки
     submission_datetime = datetime.now()
@@ -326,148 +278,308 @@ async def process_canteen(message: types.Message, state: FSMContext):
     submission_time = submission_datetime.time()
     
     # Сохраняем заявку
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
     try:
-        # Проверяем, есть ли уже заявка на эту дату
-        cursor.execute(
-            "SELECT id FROM requests WHERE user_id = ? AND meal_date = ?",
-            (user_id_db, meal_date.strftime("%Y-%m-%d"))
-        )
-        existing_request = cursor.fetchone()
-        
-        if existing_request:
-            # Обновляем существующую заявку
-            cursor.execute(
-                "UPDATE requests SET canteen = ?, submission_date = ?, submission_time = ? WHERE id = ?",
-                (canteen, submission_date.strftime("%Y-%m-%d"), submission_time.strftime("%H:%M:%S"), existing_request[0]))
-            action_msg = "обновлена"
-        else:
-            # Добавляем новую заявку
-            cursor.execute(
-                "INSERT INTO requests (user_id, meal_date, submission_date, submission_time, canteen) VALUES (?, ?, ?, ?, ?)",
-                (user_id_db, meal_date.strftime("%Y-%m-%d"), submission_date.strftime("%Y-%m-%d"), submission_time.strftime("%H:%M:%S"), canteen))
-            action_msg = "подана"
-        
-        conn.commit()
+        action_msg = await db.upsert_request(
+            user_id_db,
+            meal_date.strftime("%Y-%m-%d"),
+            canteen,
+            submission_date.strftime("%Y-%m-%d"),
+            submission_time.strftime("%H:%M:%S"))
         await message.answer(
             f"✅ Заявка на питание в столовой '{canteen}' {action_msg} на {meal_date.strftime('%d.%m.%Y')}!\n"
             f"📅 Дата подачи: {submission_date.strftime('%d.%m.%Y')}\n"
             f"⏰ Время подачи: {submission_time.strftime('%H:%M:%S')}",
-            reply_markup=create_main_menu(user_id == ADMIN_ID))
+            reply_markup=main_menu(user_id == ADMIN_ID))
         logger.info(f"Заявка сохранена: {user_id} -> {canteen} на {meal_date}")
+        manifest_changed(meal_date, user_id_db, full_name, canteen)
     except Exception as e:
         logger.error(f"Ошибка при сохранении заявки: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при сохранении заявки. Попробуйте еще раз.")
     finally:
-        conn.close()
         await state.clear()
 
-# Обработчик кнопки "Экспорт в Excel" (с объединением даты и времени подачи)
+# Обработчик кнопки "План на неделю": все дни недели на одном inline-экране
+@dp.message(F.text == BTN_WEEK_PLAN)
+async def week_plan_handler(message: types.Message, state: FSMContext):
+    user = await user_registry.get(message.from_user.id)
+    if not user:
+        await message.answer("Пожалуйста, сначала зарегистрируйтесь с помощью команды /start.")
+        return
+    
+    days = plan_dates()
+    # Уже поданные заявки отмечены сразу
+    plan = await db.get_user_requests(user[0], days[0].isoformat(), days[-1].isoformat())
+    await state.set_state(Form.planning_week)
+    await state.set_data({
+        "user_id": user[0],
+        "days": [d.isoformat() for d in days],
+        "plan": plan,
+        "plan_original": plan,
+    })
+    await message.answer(
+        f"{user[1]}, отметьте столовую на каждый нужный день и нажмите «Сохранить».\n"
+        "Ходите в одну столовую? Нажмите ее в строке «📌 Все будни» - план сохранится сразу.",
+        reply_markup=week_plan_keyboard(days, plan))
+    logger.info(f"Пользователь {message.from_user.id} открыл план на неделю")
+
+# Нажатия кнопок планировщика
+@dp.callback_query(Form.planning_week, PlanCallback.filter())
+async def week_plan_callback(callback: types.CallbackQuery, callback_data: PlanCallback, state: FSMContext):
+    data = await state.get_data()
+    plan = dict(data.get("plan", {}))
+    
+    if callback_data.action == "noop":
+        await callback.answer()
+        return
+    
+    if callback_data.action == "cancel":
+        await state.clear()
+        await callback.message.edit_text("План на неделю не изменен.")
+        await callback.answer()
+        return
+    
+    if callback_data.action == "weekdays":
+        if not 0 <= callback_data.canteen < len(CANTEENS):
+            await callback.answer()
+            return
+        # Одно нажатие вместо отметки каждого дня: все будни в одну столовую и сразу сохранение
+        for day in data.get("days", []):
+            if date.fromisoformat(day).weekday() < 5:
+                plan[day] = CANTEENS[callback_data.canteen]
+    
+    if callback_data.action in ("save", "weekdays"):
+        original = data.get("plan_original", {})
+        removed = [day for day in original if day not in plan]
+        changed = {day: canteen for day, canteen in plan.items() if original.get(day) != canteen}
+        now = datetime.now()
+        try:
+            # Все дни сохраняются одной транзакцией
+            await db.save_week_plan(
+                data["user_id"], changed, removed,
+                now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"))
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении плана на неделю: {e}", exc_info=True)
+            await callback.answer("❌ Ошибка при сохранении, попробуйте еще раз.", show_alert=True)
+            return
+        await state.clear()
+        user = await user_registry.get(callback.from_user.id)
+        if user:
+            for day, canteen in changed.items():
+                manifest_changed(date.fromisoformat(day), data["user_id"], user[1], canteen)
+            for day in removed:
+                manifest_changed(date.fromisoformat(day), data["user_id"], user[1], None)
+        lines = [
+            f"- {date.fromisoformat(day).strftime('%d.%m.%Y')}: {canteen}"
+            for day, canteen in sorted(plan.items())
+        ]
+        await callback.message.edit_text(
+            "✅ План на неделю сохранен!\n" + ("\n".join(lines) if lines else "Заявок на неделю нет."))
+        await callback.answer()
+        logger.info(f"Пользователь {callback.from_user.id} сохранил план: {len(changed)} изменено, {len(removed)} удалено")
+        return
+    
+    if callback_data.day not in data.get("days", []):
+        await callback.answer()
+        return
+    
+    if callback_data.action == "set" and 0 <= callback_data.canteen < len(CANTEENS):
+        plan[callback_data.day] = CANTEENS[callback_data.canteen]
+    elif callback_data.action == "clear":
+        plan.pop(callback_data.day, None)
+    else:
+        await callback.answer()
+        return
+    
+    await state.update_data(plan=plan)
+    # Клавиатура того же сообщения обновляется без новых сообщений
+    days = [date.fromisoformat(day) for day in data["days"]]
+    await callback.message.edit_reply_markup(reply_markup=week_plan_keyboard(days, plan))
+    await callback.answer()
+
+# Кнопки устаревшего экрана планировщика
+@dp.callback_query(PlanCallback.filter())
+async def stale_plan_callback(callback: types.CallbackQuery):
+    await callback.answer("Этот план уже закрыт. Откройте «План на неделю» заново.", show_alert=True)
+
+# Выгрузки без форматирования для скриптов: пишутся сжатыми в память
+STREAM_EXPORTS = {"csv": (write_csv_gz, "csv.gz"), "jsonl": (write_jsonl_gz, "jsonl.gz")}
+
+# Обработчик кнопки "Экспорт в Excel": предлагает выбрать формат
 @dp.message(F.text == "📥 Экспорт в Excel")
 async def export_handler(message: types.Message):
+    await send_export_menu(message)
+
+# Выгрузка вместе с архивом: /export_history
+@dp.message(Command("export_history"))
+async def export_history_handler(message: types.Message):
+    await send_export_menu(message, history=True)
+
+async def send_export_menu(message, history=False):
     # Проверяем, является ли пользователь администратором
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Эта команда доступна только администратору.")
         logger.warning(f"Пользователь {message.from_user.id} попытался использовать экспорт без прав")
         return
     
+    await message.answer(export_menu_text(ExportCallback(action="menu", history=history)),
+                         reply_markup=export_keyboard(history))
+
+def export_filter(callback_data):
+    date_from, date_to = period_range(callback_data.period, date.today(), callback_data.date_from, callback_data.date_to)
+    canteen = CANTEENS[callback_data.canteen] if 0 <= callback_data.canteen < len(CANTEENS) else None
+    return ExportFilter(date_from, date_to, canteen)
+
+def export_menu_text(callback_data):
+    history = " с архивом" if callback_data.history else ""
+    return f"📥 Выгрузка заявок{history}: {export_filter(callback_data).describe()}.\nВыберите формат:"
+
+def export_menu_markup(callback_data):
+    return export_keyboard(callback_data.history, callback_data.period, callback_data.canteen,
+                           callback_data.date_from, callback_data.date_to)
+
+# Экран выгрузки: выбор периода, столовой и формата
+@dp.callback_query(ExportCallback.filter())
+async def export_callback(callback: types.CallbackQuery, callback_data: ExportCallback, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ Эта команда доступна только администратору.", show_alert=True)
+        return
+    
+    if callback_data.action in ("period", "canteen"):
+        # Клавиатура перестраивается на месте; повторное нажатие на выбранную кнопку ничего не меняет
+        markup = export_menu_markup(callback_data)
+        if markup != callback.message.reply_markup:
+            await callback.message.edit_text(export_menu_text(callback_data), reply_markup=markup)
+        await callback.answer()
+        return
+    
+    if callback_data.action == "custom":
+        await state.set_state(Form.waiting_for_export_range)
+        await state.update_data(export_history=callback_data.history, export_canteen=callback_data.canteen)
+        await callback.answer()
+        await callback.message.answer("Введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ (например, 01.10.2025-31.10.2025):")
+        return
+    
+    if callback_data.action != "go" or callback_data.fmt not in EXPORT_FORMATS:
+        await callback.answer()
+        return
+    
+    await callback.answer()
+    message = callback.message
     try:
-        logger.info("Начало экспорта в Excel...")
-        
-        # Создаем подключение к базе данных
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Получаем данные
-        query = """
-        SELECT 
-            u.full_name AS ФИО,
-            r.meal_date AS Дата_питания,
-            r.submission_date AS Дата_подачи,
-            r.submission_time AS Время_подачи,
-            r.canteen AS Столовая
-        FROM requests r
-        JOIN users u ON u.id = r.user_id
-        ORDER BY r.meal_date DESC, u.full_name
-        """
-        
-        logger.info("Выполняем SQL-запрос...")
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        logger.info(f"Получено {len(rows)} записей из БД")
-        
-        # Если данных нет
-        if not rows:
-            await message.answer("Нет данных для экспорта.")
-            conn.close()
-            logger.info("Нет данных для экспорта")
-            return
-        
-        # Создаем Excel-файл
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Заявки"
-        
-        # Заголовки
-        headers = ["ФИО", "Дата питания", "Дата и время подачи", "Столовая"]
-        ws.append(headers)
-        
-        # Стили для заголовков
-        bold_font = Font(bold=True)
-        center_alignment = Alignment(horizontal='center')
-        
-        for col in range(1, 5):
-            cell = ws.cell(row=1, column=col)
-            cell.font = bold_font
-            cell.alignment = center_alignment
-        
-        # Данные
-        for row in rows:
-            # Форматируем даты
-            meal_date = datetime.strptime(row[1], "%Y-%m-%d").strftime("%d.%m.%Y")
-            submission_date = datetime.strptime(row[2], "%Y-%m-%d").strftime("%d.%m.%Y")
-            submission_time = row[3]  # Время уже в формате строки
-            
-            # Объединяем дату и время подачи
-            full_submission = f"{submission_date} {submission_time}"
-            
-            ws.append([row[0], meal_date, full_submission, row[4]])
-        
-        # Устанавливаем ширину столбцов
-        ws.column_dimensions['A'].width = 30
-        ws.column_dimensions['B'].width = 15
-        ws.column_dimensions['C'].width = 20  # Увеличим для полной даты-времени
-        ws.column_dimensions['D'].width = 15
-        
-        # Сохраняем файл
-        today_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        excel_filename = f"meal_requests_{today_str}.xlsx"
-        excel_path = os.path.join(EXCEL_FOLDER, excel_filename)
-        wb.save(excel_path)
-        logger.info(f"Excel-файл сохранен: {excel_path}")
-        
-        # Проверяем размер файла
-        file_size = os.path.getsize(excel_path)
-        logger.info(f"Размер файла: {file_size} байт")
-        
-        # Отправляем файл пользователю
-        await message.answer_document(
-            types.FSInputFile(excel_path, filename=excel_filename),
-            caption=f"Экспорт заявок на питание ({len(rows)} записей)"
-        )
-        logger.info("Файл успешно отправлен")
-        
-        # Отправляем подтверждение
-        await message.answer("✅ Файл успешно экспортирован и отправлен!")
-        
+        logger.info(f"Начало экспорта ({callback_data.fmt})...")
+        # Отчет строится по снимку базы администратора, а не по рабочей базе
+        async with snapshots.use(callback.from_user.id, callback_data.history) as snapshot:
+            await export_snapshot(message, snapshot, callback_data.history, callback_data.fmt,
+                                  export_filter(callback_data))
     except Exception as e:
         error_msg = f"❌ Ошибка при создании отчета: {str(e)}"
-        logger.error(f"Ошибка при экспорте в Excel: {e}", exc_info=True)
+        logger.error(f"Ошибка при экспорте ({callback_data.fmt}): {e}", exc_info=True)
         await message.answer(error_msg)
-    finally:
-        conn.close()
+
+# Ввод своего периода выгрузки
+@dp.message(Form.waiting_for_export_range)
+async def process_export_range(message: types.Message, state: FSMContext):
+    match = re.fullmatch(r"\s*(\d{2}\.\d{2}\.\d{4})\s*[-–—]\s*(\d{2}\.\d{2}\.\d{4})\s*", message.text or "")
+    try:
+        if not match:
+            raise ValueError
+        date_from = datetime.strptime(match.group(1), "%d.%m.%Y").date()
+        date_to = datetime.strptime(match.group(2), "%d.%m.%Y").date()
+    except ValueError:
+        await message.answer("❌ Неверный формат. Введите период как ДД.ММ.ГГГГ-ДД.ММ.ГГГГ:")
+        return
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    
+    data = await state.get_data()
+    await state.clear()
+    callback_data = ExportCallback(
+        action="menu", history=data.get("export_history", False), period="custom",
+        canteen=data.get("export_canteen", -1), date_from=date_from.isoformat(), date_to=date_to.isoformat())
+    await message.answer(export_menu_text(callback_data), reply_markup=export_menu_markup(callback_data))
+
+async def export_snapshot(message, snapshot, history, fmt="xlsx", selection=None):
+    archive_name = snapshot.archive_path if history else None
+    selection = selection or ExportFilter()
+    cache_key = f"{fmt}:{'history' if history else 'hot'}:{selection.key()}"
+    snapshot_time = snapshot.created.strftime("%d.%m.%Y %H:%M:%S")
+    
+    # Если данные не менялись с прошлой выгрузки - отправляем уже загруженный файл
+    version = snapshot.version
+    cached = export_cache.get(cache_key, version)
+    if cached:
+        file_id, caption = cached
+        await message.answer_document(file_id, caption=caption)
+        logger.info(f"Отправлен кэшированный отчет (версия данных {version})")
+        return
+    
+    total = await asyncio.to_thread(count_export_rows, snapshot.path, archive_name, selection)
+    logger.info(f"Записей для экспорта: {total}")
+    
+    # Если данных нет
+    if not total:
+        await message.answer("Нет данных для экспорта.")
+        logger.info("Нет данных для экспорта")
+        return
+    
+    progress_message = await message.answer(f"⏳ Формируем отчет: 0 из {total} записей...")
+    loop = asyncio.get_running_loop()
+    
+    def report_progress(written):
+        # Вызывается из рабочего потока экспорта
+        asyncio.run_coroutine_threadsafe(
+            progress_message.edit_text(f"⏳ Формируем отчет: {written} из {total} записей..."), loop)
+    
+    # Формируем файл потоково в отдельном потоке, не блокируя цикл событий
+    today_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    basename = f"meal_requests_{'history_' if history else ''}{today_str}"
+    if fmt in STREAM_EXPORTS:
+        writer, extension = STREAM_EXPORTS[fmt]
+        filename = f"{basename}.{extension}"
+        data, written = await asyncio.to_thread(writer, snapshot.path, report_progress, archive_name, selection)
+        document = types.BufferedInputFile(data, filename=filename)
+        file_size = len(data)
+    else:
+        filename = f"{basename}.xlsx"
+        excel_path = os.path.join(EXCEL_FOLDER, filename)
+        written = await asyncio.to_thread(write_excel, snapshot.path, excel_path, report_progress, archive_name,
+                                        selection)
+        document = types.FSInputFile(excel_path, filename=filename)
+        file_size = os.path.getsize(excel_path)
+    await progress_message.edit_text(f"✅ Отчет сформирован: {written} записей")
+    
+    # Проверяем размер файла
+    logger.info(f"Размер файла: {file_size} байт")
+    
+    # Отправляем файл пользователю
+    caption = (f"Экспорт заявок на питание{' с архивом' if history else ''} ({written} записей)\n"
+               f"Отбор: {selection.describe()}\n"
+               f"Данные на {snapshot_time}")
+    sent = await message.answer_document(document, caption=caption)
+    export_cache.put(cache_key, version, sent.document.file_id, caption)
+    logger.info("Файл успешно отправлен")
+    if fmt not in STREAM_EXPORTS:
+        await asyncio.to_thread(prune_reports, EXCEL_FOLDER)
+    
+    # Отправляем подтверждение
+    await message.answer("✅ Файл успешно экспортирован и отправлен!")
+
+# Новый снимок базы для отчетов: /snapshot
+@dp.message(Command("snapshot"))
+async def snapshot_handler(message: types.Message):
+    # Проверяем, является ли пользователь администратором
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+    
+    try:
+        async with snapshots.use(message.from_user.id, fresh=True) as snapshot:
+            await message.answer(
+                f"📸 Снимок базы обновлен: данные на {snapshot.created.strftime('%d.%m.%Y %H:%M:%S')}.\n"
+                "Следующие отчеты строятся по нему.")
+    except Exception as e:
+        logger.error(f"Ошибка при создании снимка базы: {e}", exc_info=True)
+        await message.answer(f"❌ Ошибка при создании снимка базы: {str(e)}")
 
 # Обработчик кнопки "Очистить базу"
 @dp.message(F.text == "🧹 Очистить базу")
@@ -478,13 +590,13 @@ async def clear_db_handler(message: types.Message):
         return
     
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
         # Удаляем все данные
-        cursor.execute("DELETE FROM requests")
-        cursor.execute("DELETE FROM users")
-        conn.commit()
+        await db.clear_all()
+        user_registry.invalidate()
+        manifests.invalidate()
+        if worker_server is not None:
+            # Кэши пользователей есть в каждом воркере
+            await worker_server.broadcast("invalidate")
         
         await message.answer("✅ База данных полностью очищена!")
         logger.info("База данных очищена администратором")
@@ -492,8 +604,6 @@ async def clear_db_handler(message: types.Message):
     except Exception as e:
         logger.error(f"Ошибка при очистке БД: {e}")
         await message.answer(f"❌ Ошибка при очистке базы данных: {str(e)}")
-    finally:
-        conn.close()
 
 # Обработчик кнопки "Удалить мои данные"
 @dp.message(F.text == "❌ Удалить мои данные")
@@ -501,17 +611,14 @@ async def delete_me_handler(message: types.Message):
     user_id = message.from_user.id
     
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Удаляем заявки пользователя
-        cursor.execute("DELETE FROM requests WHERE user_id IN (SELECT id FROM users WHERE telegram_id = ?)", (user_id,))
-        
-        # Удаляем самого пользователя
-        cursor.execute("DELETE FROM users WHERE telegram_id = ?", (user_id,))
-        conn.commit()
+        # Удаляем заявки и самого пользователя
+        user = await user_registry.get(user_id)
+        deleted = await user_registry.delete(user_id)
+        if user:
+            for meal_date, change in manifests.remove_user(user[0]):
+                push_manifest_change(meal_date, change)
         
-        if cursor.rowcount > 0:
+        if deleted > 0:
             await message.answer("✅ Ваши данные полностью удалены из системы!", reply_markup=ReplyKeyboardRemove())
             logger.info(f"Пользователь {user_id} удалил свои данные")
         else:
@@ -520,43 +627,39 @@ async def delete_me_handler(message: types.Message):
     except Exception as e:
         logger.error(f"Ошибка при удалении пользователя {user_id}: {e}")
         await message.answer(f"❌ Произошла ошибка при удалении данных: {str(e)}")
-    finally:
-        conn.close()
 
 # Обработчик кнопки "Статистика"
 @dp.message(F.text == "📊 Статистика")
 async def stats_handler(message: types.Message):
+    await send_stats(message)
+
+# Статистика вместе с архивом: /stats_history
+@dp.message(Command("stats_history"))
+async def stats_history_handler(message: types.Message):
+    await send_stats(message, history=True)
+
+async def send_stats(message, history=False):
     # Проверяем, является ли пользователь администратором
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Эта команда доступна только администратору.")
         return
     
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Количество пользователей
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
-        
-        # Количество заявок
-        cursor.execute("SELECT COUNT(*) FROM requests")
-        requests_count = cursor.fetchone()[0]
-        
-        # Последняя заявка
-        cursor.execute("SELECT MAX(meal_date) FROM requests")
-        last_meal_date = cursor.fetchone()[0] or "нет данных"
+        stats = await db.count_stats(history)
+        users_count = stats["users"]
+        requests_count = stats["requests"]
+        last_meal_date = stats["last_meal_date"] or "нет данных"
+        canteen_stats = stats["canteens"]
+        date_stats = stats["dates"]
         
-        # Статистика по столовым
-        cursor.execute("SELECT canteen, COUNT(*) FROM requests GROUP BY canteen")
-        canteen_stats = cursor.fetchall()
-        
-        # Статистика по датам
-        cursor.execute("SELECT meal_date, COUNT(*) FROM requests GROUP BY meal_date ORDER BY meal_date DESC LIMIT 7")
-        date_stats = cursor.fetchall()
-        
-        stats_message = (
-            "📊 Статистика бота:\n"
+        if history:
+            stats_message = (
+                f"📊 Статистика бота с архивом (с {stats['first_meal_date'] or 'нет данных'}):\n"
+                f"🗄 В архиве: {stats['archived']} заявок\n"
+            )
+        else:
+            stats_message = "📊 Статистика бота:\n"
+        stats_message += (
             f"👤 Пользователей: {users_count}\n"
             f"📝 Заявок: {requests_count}\n"
             f"📅 Последняя дата питания: {last_meal_date}\n\n"
@@ -570,13 +673,38 @@ async def stats_handler(message: types.Message):
         for meal_date, count in date_stats:
             stats_message += f"- {meal_date}: {count} заявок\n"
         
+        queue = db.queue_stats()
+        cache = user_registry.stats()
+        stats_message += (
+            f"\n⏱ Очередь БД: {queue['calls']} запросов, "
+            f"ожидание среднее {queue['wait_avg'] * 1000:.1f} мс, макс {queue['wait_max'] * 1000:.1f} мс\n"
+            f"🗂 Кэш пользователей: {cache['size']} записей, попаданий {cache['hits']}, промахов {cache['misses']}"
+        )
+        
         await message.answer(stats_message)
         
     except Exception as e:
         logger.error(f"Ошибка при получении статистики: {e}")
         await message.answer(f"❌ Ошибка при получении статистики: {str(e)}")
-    finally:
-        conn.close()
+
+# Команда проверки и пересборки сводной статистики
+@dp.message(Command("rebuild_stats"))
+async def rebuild_stats_handler(message: types.Message):
+    # Проверяем, является ли пользователь администратором
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+    
+    try:
+        mismatched = await db.rebuild_stats()
+        if mismatched:
+            await message.answer(f"⚠️ Сводная статистика пересобрана, исправлено расхождений: {mismatched}")
+            logger.warning(f"Сводная статистика расходилась с заявками: {mismatched} строк")
+        else:
+            await message.answer("✅ Сводная статистика согласована с заявками и пересобрана")
+    except Exception as e:
+        logger.error(f"Ошибка при пересборке статистики: {e}", exc_info=True)
+        await message.answer(f"❌ Ошибка при пересборке статистики: {str(e)}")
 
 # Функция для отправки напоминаний
 async def send_reminders():
@@ -586,50 +714,197 @@ async def send_reminders():
         
         # Проверяем, будний ли день (пн-пт = 0-4)
         if today.weekday() < 5:  # 0-пн, 4-пт
-            conn = sqlite3.connect(DB_NAME)
-            cursor = conn.cursor()
-            
-            # Получаем всех пользователей
-            cursor.execute("SELECT telegram_id, full_name FROM users")
-            users = cursor.fetchall()
+            tomorrow = today + timedelta(days=1)
             
-            for user_id, full_name in users:
-                # Проверяем, есть ли заявка на завтра
-                tomorrow = today + timedelta(days=1)
-                cursor.execute(
-                    "SELECT COUNT(*) FROM requests r JOIN users u ON u.id = r.user_id WHERE u.telegram_id = ? AND r.meal_date = ?",
-                    (user_id, tomorrow.strftime("%Y-%m-%d"))
-                )
-                has_request = cursor.fetchone()[0] == 0
-                
-                if has_request:
-                    try:
-                        await bot.send_message(
+            # Пользователи без заявки на завтра
+            async def reminders():
+                async for users in db.iter_users_without_request(tomorrow.strftime("%Y-%m-%d")):
+                    for user_id, full_name in users:
+                        yield (
                             user_id,
                             f"⏰ {full_name}, не забудьте подать заявку на питание на завтра ({tomorrow.strftime('%d.%m.%Y')})!\n"
                             "Используйте кнопку '🍽 Подать заявку'"
                         )
-                        logger.info(f"Напоминание отправлено {user_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки напоминания {user_id}: {e}")
             
-            conn.close()
+            report = await broadcaster.broadcast(reminders())
+            logger.info(f"Отчет о напоминаниях:\n{report.summary()}")
         logger.info("Завершена отправка напоминаний")
     except Exception as e:
         logger.error(f"Ошибка в функции напоминаний: {e}", exc_info=True)
 
+# ================= Список для кухни =================
+
+def manifest_meal_date():
+    return datetime.now(TIMEZONE).date() + timedelta(days=1)
+
+def after_cutoff():
+    now = datetime.now(TIMEZONE)
+    return (now.hour, now.minute) >= (MANIFEST_CUTOFF_HOUR, MANIFEST_CUTOFF_MINUTE)
+
+async def send_manifest(chat_id, manifest, title=None):
+    if title:
+        await bot.send_message(chat_id, title)
+    for text in manifest.render():
+        await bot.send_message(chat_id, text)
+
+# Задача на отсечке: формирует список на завтра и рассылает его
+async def build_manifest(notify=True):
+    try:
+        manifest = await manifests.build(manifest_meal_date())
+        if not notify:
+            return
+        for chat_id in MANIFEST_RECIPIENTS:
+            try:
+                await send_manifest(chat_id, manifest)
+            except Exception as e:
+                logger.error(f"Не удалось отправить список для кухни {chat_id}: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка при формировании списка для кухни: {e}", exc_info=True)
+
+def manifest_changed(meal_date, user_id, full_name, canteen):
+    # Изменение заявки после отсечки: дельта к готовому списку и уведомление получателям
+    change = manifests.apply(meal_date, user_id, full_name, canteen)
+    if change:
+        push_manifest_change(meal_date, change)
+
+def push_manifest_change(meal_date, change):
+    if not change:
+        return
+
+    async def push():
+        manifest = manifests.get(meal_date)
+        if worker_server is not None:
+            # Итоги считаются по базе: заявки пользователей других воркеров в этом процессе не видны
+            try:
+                manifest = await manifests.refresh(meal_date)
+            except Exception as e:
+                logger.error(f"Не удалось обновить список на {meal_date} из базы: {e}")
+        counts = ", ".join(f"{canteen} - {count}" for canteen, count in manifest.counts().items())
+        text = (f"✏️ Изменение в списке на {meal_date.strftime('%d.%m.%Y')}:\n"
+                f"{format_change(change)}\n"
+                f"Всего: {counts}")
+        for chat_id in MANIFEST_RECIPIENTS:
+            try:
+                await bot.send_message(chat_id, text)
+            except Exception as e:
+                logger.error(f"Не удалось отправить изменение списка {chat_id}: {e}")
+    
+    # Отправка не задерживает ответ пользователю, который изменил заявку
+    asyncio.create_task(push())
+
+# Обработчик кнопки "Список для кухни" и команды /manifest
+@dp.message(F.text == BTN_MANIFEST)
+@dp.message(Command("manifest"))
+async def manifest_handler(message: types.Message):
+    # Проверяем, является ли пользователь администратором
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+    
+    try:
+        meal_date = manifest_meal_date()
+        manifest = manifests.get(meal_date)
+        if manifest is None and after_cutoff():
+            # Бот перезапускался после отсечки - формируем список сейчас
+            manifest = await manifests.build(meal_date)
+        elif manifest is not None and worker_server is not None:
+            # Поздние изменения пользователей других воркеров есть только в базе
+            manifest = await manifests.refresh(meal_date)
+        if manifest is not None:
+            await send_manifest(message.chat.id, manifest)
+            return
+        manifest = await manifests.preview(meal_date)
+        await send_manifest(
+            message.chat.id, manifest,
+            f"⚠️ Предварительный список: прием заявок открыт до "
+            f"{MANIFEST_CUTOFF_HOUR:02d}:{MANIFEST_CUTOFF_MINUTE:02d}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка для кухни: {e}", exc_info=True)
+        await message.answer(f"❌ Ошибка при получении списка для кухни: {str(e)}")
+
+# Перенос старых заявок в архив (по расписанию и командой /archive)
+async def archive_requests():
+    try:
+        before = date.today() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        moved = await db.archive_requests(before, max_rows=HOT_MAX_ROWS)
+        logger.info(f"Архивация завершена: перенесено {moved} заявок (раньше {before})")
+        return moved
+    except Exception as e:
+        logger.error(f"Ошибка архивации заявок: {e}", exc_info=True)
+        raise
+
+@dp.message(Command("archive"))
+async def archive_handler(message: types.Message):
+    # Проверяем, является ли пользователь администратором
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+    
+    try:
+        await message.answer("⏳ Переносим старые заявки в архив...")
+        moved = await archive_requests()
+        await message.answer(f"✅ В архив перенесено заявок: {moved}")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка архивации: {str(e)}")
+
+# Команда рассылки объявления всем пользователям: /broadcast <текст>
+@dp.message(Command("broadcast"))
+async def broadcast_handler(message: types.Message):
+    # Проверяем, является ли пользователь администратором
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Эта команда доступна только администратору.")
+        return
+    
+    text = (message.text or "").partition(" ")[2].strip()
+    if not text:
+        await message.answer("Использование: /broadcast <текст объявления>")
+        return
+    
+    async def announcements():
+        async for users in db.iter_users():
+            for user_id, _ in users:
+                yield user_id, f"📢 {text}"
+    
+    await message.answer("⏳ Рассылка запущена...")
+    report = await broadcaster.broadcast(announcements())
+    await message.answer(f"✅ Рассылка завершена\n{report.summary()}")
+    logger.info(f"Администратор выполнил рассылку: {report.sent}/{report.total}")
+
 # Обработчик неизвестных команд
 @dp.message()
 async def unknown_command(message: types.Message):
     await message.answer(
         "Я вас не понял. Используйте кнопки меню для работы с ботом.",
-        reply_markup=create_main_menu(message.from_user.id == ADMIN_ID)
+        reply_markup=main_menu(message.from_user.id == ADMIN_ID)
     )
 
-# Запуск бота
-async def main():
-    logger.info("Бот запущен")
-    # Отправляем сообщение администратору при запуске
+# Прием обновлений через webhook
+async def run_webhook(args, dispatcher=dp):
+    if args.webhook_url and not args.secret_token:
+        # Публичный webhook без секрета принял бы поддельные обновления от кого угодно,
+        # в том числе "от администратора" - генерируем секрет на время работы
+        args.secret_token = secrets.token_urlsafe(32)
+        logger.info("Секрет webhook не задан - сгенерирован новый")
+    server = WebhookServer(
+        dispatcher, bot,
+        secret_token=args.secret_token,
+        path=args.webhook_path,
+        max_concurrency=args.max_concurrency,
+        max_body_size=args.max_body_size,
+        # Фронт ждет только передачи в воркер: если воркер недоступен, Telegram повторит обновление
+        handle_in_background=dispatcher is dp,
+    )
+    await server.start(args.host, args.port)
+    if args.webhook_url:
+        await bot.set_webhook(args.webhook_url + args.webhook_path, secret_token=args.secret_token)
+        logger.info(f"Webhook зарегистрирован: {args.webhook_url}{args.webhook_path}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+# Сообщение администратору о запуске
+async def notify_admin():
     try:
         await bot.send_message(
             ADMIN_ID, 
@@ -644,19 +919,187 @@ async def main():
         )
     except Exception as e:
         logger.error(f"Не удалось отправить сообщение администратору: {e}")
+
+# Планировщик напоминаний (APScheduler импортируется только здесь)
+def start_scheduler(primary=True):
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
     
-    # Создаем планировщик для напоминаний
     scheduler = AsyncIOScheduler()
+    cutoff = CronTrigger(day_of_week=MANIFEST_DAYS, hour=MANIFEST_CUTOFF_HOUR,
+                         minute=MANIFEST_CUTOFF_MINUTE, timezone=TIMEZONE)
+    if not primary:
+        # Остальные воркеры только строят свой список для кухни на отсечке,
+        # чтобы применять к нему поздние изменения своих пользователей
+        scheduler.add_job(build_manifest, trigger=cutoff, kwargs={"notify": False})
+        scheduler.start()
+        return scheduler
     # Напоминание каждый будний день в 16:00 по Москве
     scheduler.add_job(
         send_reminders,
-        trigger=CronTrigger(day_of_week="mon-fri", hour=16, minute=0, timezone="Europe/Moscow"),
+        trigger=CronTrigger(day_of_week="mon-fri", hour=16, minute=0, timezone=TIMEZONE),
+    )
+    # Архивация старых заявок каждую ночь, когда бот почти не нагружен
+    scheduler.add_job(
+        archive_requests,
+        trigger=CronTrigger(hour=3, minute=30, timezone=TIMEZONE),
     )
+    # Список для кухни на завтра - на отсечке приема заявок
+    scheduler.add_job(build_manifest, trigger=cutoff)
     scheduler.start()
-    logger.info("Планировщик напоминаний запущен (будни в 16:00)")
+    logger.info(f"Планировщик запущен (напоминания по будням в 16:00, архивация в 03:30, "
+                f"список для кухни в {MANIFEST_CUTOFF_HOUR:02d}:{MANIFEST_CUTOFF_MINUTE:02d})")
+    return scheduler
+
+# Прогрев перед приемом обновлений: схема и подключение к БД, кэш пользователей, клавиатуры
+async def warm_up():
+    started = time.perf_counter()
+    db.init_schema()
+    logger.info("База данных инициализирована")
+    loaded = await user_registry.preload()
+    date_keyboard()
+    logger.info(f"Прогрев завершен за {(time.perf_counter() - started) * 1000:.0f} мс, пользователей в кэше: {loaded}")
+
+def use_api_server(args, bucket=None):
+    # Локальный сервер Bot API вместо api.telegram.org
+    if args.api_server:
+        bot.session.api = TelegramAPIServer.from_base(args.api_server)
+    # Лимит Telegram на отправку общий для бота - в режиме нескольких процессов ведро одно на всех воркеров
+    if bucket is not None:
+        outbound_queue.bucket = bucket
+    elif args.send_rate != GLOBAL_RATE:
+        outbound_queue.bucket = TokenBucket(args.send_rate)
+
+async def shutdown(metrics_runner):
+    await fsm_storage.close()
+    await checkpoints.close()
+    snapshots.close()
+    await outbound_queue.close()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logger.info(f"Очередь БД: {db.queue_stats()}")
+    db.close()
+
+# ================= Режим нескольких процессов =================
+
+# Команды, которые другие воркеры присылают через фронт
+async def handle_control(command):
+    if command == "invalidate":
+        user_registry.invalidate()
+        manifests.invalidate()
+        logger.info("Кэши пользователей и списков для кухни сброшены по команде другого воркера")
+
+def run_worker(index, args, sock, bucket):
+    # Точка входа процесса-воркера: sock - его конец канала с фронтом.
+    # Ctrl+C получает вся группа процессов; воркер завершается, когда фронт закроет канал,
+    # иначе фронт принял бы остановку за падение и запустил воркер заново
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_main(index, args, sock, bucket))
+
+async def worker_main(index, args, sock, bucket):
+    global worker_server
+    # Фоновые задачи (напоминания, архивация, контрольные точки WAL) выполняет только воркер 0
+    primary = index == 0
+    logger.info(f"Воркер {index} запущен")
+    use_api_server(args, bucket)
+    await warm_up()
+    start_scheduler(primary)
+    fsm_storage.start()
+    if primary:
+        checkpoints.start()
+    metrics_runner = None
+    if args.metrics_port:
+        metrics_runner = await metrics.start_server(port=args.metrics_port + 1 + index)
+    worker_server = WorkerServer(dp, bot, handle_control, args.max_concurrency)
+    await worker_server.start(sock)
+    try:
+        if primary:
+            asyncio.create_task(notify_admin())
+        await worker_server.wait_closed()
+    finally:
+        await worker_server.stop()
+        await shutdown(metrics_runner)
+
+async def run_front(args):
+    # Фронт принимает обновления и раздает их воркерам по пользователю, сам обновления не обрабатывает
+    logger.info(f"Фронт запущен, воркеров: {args.workers}")
+    use_api_server(args)
+    # Схема создается до запуска воркеров, чтобы миграции не выполнялись параллельно
+    db.init_schema()
+    db.close()
+    context = multiprocessing.get_context("spawn")
+    bucket = SharedTokenBucket(args.send_rate, context=context)
+
+    def spawn(index, sock):
+        process = context.Process(target=run_worker, args=(index, args, sock, bucket), name=f"worker-{index}")
+        process.start()
+        return process
+
+    router = ShardRouter(args.workers, spawn)
+    metrics_runner = None
+    if args.metrics_port:
+        metrics_runner = await metrics.start_server(port=args.metrics_port)
+    try:
+        await router.start()
+        if args.mode == "webhook":
+            await run_webhook(args, router)
+        else:
+            await bot.delete_webhook()
+            await poll_updates(bot, router)
+    finally:
+        await router.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+# Запуск бота
+async def main(args):
+    if args.workers > 1:
+        await run_front(args)
+        return
+    logger.info("Бот запущен")
+    use_api_server(args)
+    await warm_up()
+    start_scheduler()
     
-    await dp.start_polling(bot)
+    fsm_storage.start()
+    checkpoints.start()
+    metrics_runner = None
+    if args.metrics_port:
+        metrics_runner = await metrics.start_server(port=args.metrics_port)
+    try:
+        if args.mode == "webhook":
+            asyncio.create_task(notify_admin())
+            await run_webhook(args)
+        else:
+            await bot.delete_webhook()
+            # Уведомление отправляется параллельно и не задерживает первое обновление
+            asyncio.create_task(notify_admin())
+            await dp.start_polling(bot)
+    finally:
+        await shutdown(metrics_runner)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бот заявок на питание")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling",
+                        help="способ получения обновлений")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес webhook-сервера")
+    parser.add_argument("--port", type=int, default=8080, help="порт webhook-сервера")
+    parser.add_argument("--webhook-url", help="внешний адрес, который регистрируется в Telegram")
+    parser.add_argument("--webhook-path", default=WEBHOOK_PATH)
+    parser.add_argument("--secret-token", help="секрет для заголовка X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="сколько обновлений обрабатывается одновременно")
+    parser.add_argument("--max-body-size", type=int, default=MAX_BODY_SIZE,
+                        help="максимальный размер тела запроса в байтах")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT,
+                        help="порт локальной точки /metrics (0 - отключить); воркер i - порт + 1 + i")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов-воркеров; больше 1 - фронт раздает обновления по пользователям")
+    parser.add_argument("--api-server", help="адрес локального сервера Bot API")
+    parser.add_argument("--send-rate", type=float, default=GLOBAL_RATE,
+                        help="сколько сообщений в секунду бот отправляет во все чаты")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
\ No newline at end of file
@@ -393,19 +393,18 @@ async def send_reminders():
             conn = sqlite3.connect(DB_NAME)
             cursor = conn.cursor()
             
-            # Получаем всех пользователей
-            cursor.execute("SELECT telegram_id, full_name FROM users")
-            users = cursor.fetchall()
+            # Пользователи без заявки на сегодня - одним запросом (анти-джойн)
+            cursor.execute(
+                "SELECT u.telegram_id, u.full_name FROM users u "
+                "WHERE NOT EXISTS (SELECT 1 FROM requests r WHERE r.user_id = u.id AND r.date = ?)",
+                (today,)
+            )
             
-            for user_id, full_name in users:
-                # Проверяем, есть ли заявка на сегодня
-                cursor.execute(
-                    "SELECT COUNT(*) FROM requests r JOIN users u ON u.id = r.user_id WHERE u.telegram_id = ? AND r.date = ?",
-                    (user_id, today)
-                )
-                has_request = cursor.fetchone()[0] == 0
-                
-                if has_request:
+            while True:
+                users = cursor.fetchmany(500)
+                if not users:
+                    break
+                for user_id, full_name in users:
                     try:
                         await bot.send_message(
                             user_id,
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from outbound import BROADCAST, current_lane
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram: не чаще 1 сообщения в секунду в один чат
+CHAT_INTERVAL = 1.0
+# Сколько сообщений отправляется одновременно
+CONCURRENCY = 10
+# Сколько раз повторяем сообщение после RetryAfter
+MAX_ATTEMPTS = 5
+# Сколько ошибок сохраняем в отчете
+REPORT_ERRORS_LIMIT = 20
+
+
+# Отчет о доставке рассылки
+class DeliveryReport:
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retries = 0
+        self.errors = []
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def add_error(self, chat_id, error):
+        if len(self.errors) < REPORT_ERRORS_LIMIT:
+            self.errors.append((chat_id, str(error)))
+
+    def summary(self):
+        return (
+            f"Отправлено: {self.sent} из {self.total}\n"
+            f"Заблокировали бота: {self.blocked}\n"
+            f"Ошибок: {self.failed}\n"
+            f"Повторов после RetryAfter: {self.retries}\n"
+            f"Время: {self.duration:.1f} с"
+        )
+
+
+# Движок рассылок: параллельная отправка с обработкой RetryAfter.
+# Общий лимит скорости и паузу после RetryAfter обеспечивает очередь отправки (outbound.py)
+class Broadcaster:
+    def __init__(self, bot, chat_interval=CHAT_INTERVAL, concurrency=CONCURRENCY):
+        self.bot = bot
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self._chat_last_sent = {}
+
+    async def _wait_for_chat(self, chat_id):
+        last = self._chat_last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _deliver(self, chat_id, text, report, **kwargs):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self._wait_for_chat(chat_id)
+            try:
+                self._chat_last_sent[chat_id] = time.monotonic()
+                await self.bot.send_message(chat_id, text, **kwargs)
+                report.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                # Очередь отправки уже приостановлена на время, указанное Telegram;
+                # повтор встанет в нее и дождется конца паузы
+                logger.warning(f"RetryAfter {e.retry_after} с для {chat_id} (попытка {attempt})")
+                report.retries += 1
+            except TelegramForbiddenError as e:
+                report.blocked += 1
+                report.add_error(chat_id, e)
+                return
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения {chat_id}: {e}")
+                report.failed += 1
+                report.add_error(chat_id, e)
+                return
+        report.failed += 1
+        report.add_error(chat_id, "превышено число повторов")
+
+    async def broadcast(self, messages, **kwargs):
+        # messages - (async) итератор пар (chat_id, text); возвращает DeliveryReport
+        report = DeliveryReport()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    await self._deliver(item[0], item[1], report, **kwargs)
+                finally:
+                    queue.task_done()
+
+        # Воркеры наследуют полосу BROADCAST и пропускают вперед интерактивные ответы
+        lane_token = current_lane.set(BROADCAST)
+        try:
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        finally:
+            current_lane.reset(lane_token)
+        try:
+            if hasattr(messages, "__aiter__"):
+                async for item in messages:
+                    report.total += 1
+                    await queue.put(item)
+            else:
+                for item in messages:
+                    report.total += 1
+                    await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            self._chat_last_sent.clear()
+
+        report.duration = time.monotonic() - report.started
+        logger.info(f"Рассылка завершена: {report.sent}/{report.total}, ошибок {report.failed}, заблокировали {report.blocked}")
+        return report
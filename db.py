@@ -0,0 +1,746 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Если запрос ждал своей очереди дольше этого порога - пишем предупреждение в лог
+SLOW_QUEUE_WAIT = 0.5
+
+# Размер пачки пользователей при рассылке напоминаний
+REMINDER_CHUNK = 500
+
+# Режим журнала и настройки подключения. В WAL чтение (выгрузки) не блокирует запись заявок.
+JOURNAL_MODE = "WAL"
+# Сколько секунд ждать освобождения блокировки вместо ошибки "database is locked"
+BUSY_TIMEOUT = 5.0
+# Как часто выполняется контрольная точка WAL
+CHECKPOINT_INTERVAL = 30.0
+# До какого размера усекается WAL после контрольной точки; больше - предупреждение в лог
+WAL_MAX_BYTES = 64 * 1024 * 1024
+# Автоматическая контрольная точка (в страницах) - только страховка, обычно WAL сбрасывает CheckpointManager
+WAL_AUTOCHECKPOINT = 10000
+
+# Настройки каждого файла базы (основного и архива)
+PRAGMAS = {
+    # В WAL NORMAL не теряет целостность при сбое, fsync только на контрольной точке
+    "synchronous": "NORMAL",
+    # Кэш страниц 32 МБ (отрицательное значение - в килобайтах)
+    "cache_size": -32000,
+    # Чтение через отображение файла в память, до 256 МБ
+    "mmap_size": 256 * 1024 * 1024,
+    "journal_size_limit": WAL_MAX_BYTES,
+}
+
+# Сколько заявок переносится в архив одной транзакцией
+ARCHIVE_BATCH = 2000
+# Пауза между пачками архивации, чтобы запросы бота не ждали в очереди
+ARCHIVE_PAUSE = 0.05
+
+
+# Слой доступа к данным: одно долгоживущее подключение к SQLite на выделенном потоке.
+# Все обращения к базе идут через awaitable-методы и не блокируют цикл событий.
+class Database:
+    def __init__(self, db_name, archive_name=None, journal_mode=JOURNAL_MODE):
+        self.db_name = db_name
+        # Необязательный файл архива старых заявок, подключается через ATTACH как схема archive
+        self.archive_name = archive_name
+        self.journal_mode = journal_mode
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self._conn = None
+        self._stats_lock = threading.Lock()
+        self._calls = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # ================= Служебные методы =================
+
+    def _connect(self):
+        if self._conn is None:
+            # Транзакция сразу берет блокировку записи (с ожиданием BUSY_TIMEOUT): в режиме
+            # нескольких процессов база общая, и отложенная транзакция могла бы получить
+            # "database is locked" без ожидания при переходе от чтения к записи
+            self._conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                                         isolation_level="IMMEDIATE")
+            self._conn.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT}")
+            self._conn.execute("PRAGMA temp_store = MEMORY")
+            _configure(self._conn, "main", self.journal_mode)
+            if self.archive_name:
+                _attach_archive(self._conn, self.archive_name, self.journal_mode)
+        return self._conn
+
+    def _record_wait(self, waited):
+        metrics.DB_QUEUE_SECONDS.observe(waited)
+        with self._stats_lock:
+            self._calls += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        if waited > SLOW_QUEUE_WAIT:
+            logger.warning(f"Запрос к БД ждал в очереди {waited:.3f} с")
+
+    async def run(self, func, *args):
+        # Выполняет func(conn, *args) на потоке БД и возвращает результат
+        enqueued = time.perf_counter()
+
+        def job():
+            started = time.perf_counter()
+            self._record_wait(started - enqueued)
+            try:
+                return func(self._connect(), *args)
+            finally:
+                metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, query=func.__name__.lstrip("_"))
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+
+    def queue_stats(self):
+        # Статистика ожидания в очереди потока БД
+        with self._stats_lock:
+            avg = self._wait_total / self._calls if self._calls else 0.0
+            return {"calls": self._calls, "wait_avg": avg, "wait_max": self._wait_max}
+
+    def close(self):
+        def job():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        self._executor.submit(job).result()
+        self._executor.shutdown(wait=True)
+
+    # ================= Схема =================
+
+    def init_schema(self):
+        # Синхронная инициализация - вызывается до запуска цикла событий
+        return self._executor.submit(lambda: _init_schema(self._connect())).result()
+
+    # ================= Пользователи =================
+
+    async def get_user(self, telegram_id):
+        return await self.run(_get_user, telegram_id)
+
+    async def recent_users(self, limit):
+        return await self.run(_recent_users, limit)
+
+    async def save_user(self, telegram_id, full_name, today):
+        return await self.run(_save_user, telegram_id, full_name, today)
+
+    async def delete_user(self, telegram_id):
+        return await self.run(_delete_user, telegram_id)
+
+    # ================= Заявки =================
+
+    async def upsert_request(self, user_id, meal_date, canteen, submission_date, submission_time):
+        return await self.run(_upsert_request, user_id, meal_date, canteen, submission_date, submission_time)
+
+    async def get_user_requests(self, user_id, date_from, date_to):
+        return await self.run(_get_user_requests, user_id, date_from, date_to)
+
+    async def save_week_plan(self, user_id, plan, removed, submission_date, submission_time):
+        return await self.run(_save_week_plan, user_id, plan, removed, submission_date, submission_time)
+
+    async def manifest_rows(self, meal_date):
+        # Заявки на день для кухни: (id пользователя, ФИО, столовая)
+        return await self.run(_manifest_rows, meal_date)
+
+    async def clear_all(self):
+        return await self.run(_clear_all)
+
+    async def count_stats(self, history=False):
+        # history=True - статистика вместе с архивом
+        return await self.run(_count_stats, history and self.archive_name is not None)
+
+    async def rebuild_stats(self):
+        return await self.run(_rebuild_stats)
+
+    async def data_version(self):
+        return await self.run(_data_version)
+
+    async def checkpoint(self, mode="PASSIVE"):
+        # PASSIVE переносит страницы из WAL в основной файл, не дожидаясь читателей;
+        # TRUNCATE ждет их и обнуляет WAL (при остановке бота)
+        return await self.run(_checkpoint, mode)
+
+    def wal_size(self):
+        size = 0
+        for name in (self.db_name, self.archive_name):
+            if name and os.path.exists(f"{name}-wal"):
+                size += os.path.getsize(f"{name}-wal")
+        return size
+
+    # ================= Архив =================
+
+    async def archive_requests(self, before, max_rows=None, today=None,
+                               batch_size=ARCHIVE_BATCH, pause=ARCHIVE_PAUSE):
+        # Переносит в архив заявки с датой питания раньше before, затем самые старые
+        # прошедшие заявки, пока в рабочей таблице больше max_rows строк.
+        # Каждая пачка - отдельная короткая транзакция; между пачками поток БД свободен.
+        if not self.archive_name:
+            return 0
+        today = today or date.today()
+        moved = 0
+        while True:
+            count = await self.run(_archive_batch, before.isoformat(), batch_size)
+            moved += count
+            if count < batch_size:
+                break
+            await asyncio.sleep(pause)
+        while max_rows:
+            excess = await self.run(_hot_excess, max_rows)
+            if excess <= 0:
+                break
+            # Заявки на сегодня и будущие дни в архив не уходят
+            count = await self.run(_archive_batch, today.isoformat(), min(batch_size, excess))
+            moved += count
+            if count == 0:
+                break
+            await asyncio.sleep(pause)
+        if moved:
+            logger.info(f"В архив перенесено заявок: {moved}")
+        return moved
+
+    # ================= Сессии FSM =================
+
+    async def get_fsm_session(self, key):
+        return await self.run(_get_fsm_session, key)
+
+    async def save_fsm_sessions(self, rows):
+        return await self.run(_save_fsm_sessions, rows)
+
+    async def evict_fsm_sessions(self, before):
+        return await self.run(_evict_fsm_sessions, before)
+
+    async def iter_users_without_request(self, meal_date, chunk_size=REMINDER_CHUNK):
+        # Пользователи без заявки на meal_date - одним запросом, отдаются пачками
+        async for rows in self._iter_chunks(_users_without_request_page, chunk_size, meal_date):
+            yield rows
+
+    async def iter_users(self, chunk_size=REMINDER_CHUNK):
+        # Все пользователи пачками (для рассылок администратора)
+        async for rows in self._iter_chunks(_users_page, chunk_size):
+            yield rows
+
+    async def _iter_chunks(self, page, chunk_size, *args):
+        # Постраничное чтение по ключу: каждая пачка page(conn, после id, размер, *args) -
+        # отдельный короткий запрос. Открытый курсор держал бы читающую транзакцию всю рассылку,
+        # и при записи из другого процесса запись на этом подключении получала бы "database is locked".
+        after = 0
+        while True:
+            rows = await self.run(page, after, chunk_size, *args)
+            if not rows:
+                break
+            after = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+
+# Фоновые контрольные точки WAL: файл журнала не растет, пока бот работает
+class CheckpointManager:
+    def __init__(self, db, interval=CHECKPOINT_INTERVAL, max_wal_bytes=WAL_MAX_BYTES):
+        self.db = db
+        self.interval = interval
+        self.max_wal_bytes = max_wal_bytes
+        self._task = None
+        self._oversized = False
+
+    def start(self):
+        if self._task is None and self.db.journal_mode.upper() == "WAL":
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка контрольной точки WAL: {e}", exc_info=True)
+
+    async def run_once(self, mode="PASSIVE"):
+        busy, frames, checkpointed = await self.db.checkpoint(mode)
+        size = self.db.wal_size()
+        metrics.DB_WAL_BYTES.set(size)
+        # Долгое чтение держит старый снимок - WAL не может начаться заново, пока оно не закончится
+        if size > self.max_wal_bytes and not self._oversized:
+            logger.warning(f"WAL разросся до {size // (1024 * 1024)} МБ (перенесено {checkpointed} из {frames} страниц)")
+        elif size <= self.max_wal_bytes and self._oversized:
+            logger.info(f"WAL снова в пределах лимита: {size // 1024} КБ")
+        self._oversized = size > self.max_wal_bytes
+        return frames, checkpointed
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            await self.run_once("TRUNCATE")
+
+
+# ================= Запросы (выполняются на потоке БД) =================
+
+def _configure(conn, schema, journal_mode):
+    conn.execute(f"PRAGMA {schema}.journal_mode = {journal_mode}")
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {schema}.{name} = {value}")
+
+
+def _init_schema(conn):
+    cursor = conn.cursor()
+
+    # Таблица пользователей
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        full_name TEXT,
+        last_update DATE
+    )
+    ''')
+
+    # Таблица заявок (добавлены поля submission_date и submission_time)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        meal_date DATE,          -- Дата питания
+        submission_date DATE,    -- Дата подачи заявки
+        submission_time TIME,    -- Время подачи заявки
+        canteen TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+    conn.commit()
+    _migrate(conn)
+
+
+# Миграции схемы: номер версии хранится в PRAGMA user_version
+def _migrate_v1(conn):
+    # Удаляем дубли заявок (оставляем последнюю) перед созданием уникального индекса
+    conn.execute("""
+    DELETE FROM requests WHERE id NOT IN (
+        SELECT MAX(id) FROM requests GROUP BY user_id, meal_date
+    )
+    """)
+    # Одна заявка на пользователя в день; индекс также обслуживает анти-джойн напоминаний
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_requests_user_meal ON requests(user_id, meal_date)")
+    # Статистика и выгрузка по датам питания и столовым
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_requests_meal_canteen ON requests(meal_date, canteen)")
+
+
+def _create_daily_counts(conn, schema="main"):
+    # Сводная таблица числа заявок по дням и столовым и триггеры, которые ее поддерживают.
+    # Та же схема используется в архиве, поэтому имена таблиц в триггерах без префикса схемы.
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.daily_canteen_counts (
+        meal_date DATE,
+        canteen TEXT,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (meal_date, canteen)
+    ) WITHOUT ROWID
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {schema}.trg_requests_counts_insert AFTER INSERT ON requests
+    BEGIN
+        INSERT INTO daily_canteen_counts (meal_date, canteen, count) VALUES (NEW.meal_date, NEW.canteen, 1)
+        ON CONFLICT(meal_date, canteen) DO UPDATE SET count = count + 1;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {schema}.trg_requests_counts_delete AFTER DELETE ON requests
+    BEGIN
+        UPDATE daily_canteen_counts SET count = count - 1
+        WHERE meal_date = OLD.meal_date AND canteen = OLD.canteen;
+        DELETE FROM daily_canteen_counts
+        WHERE meal_date = OLD.meal_date AND canteen = OLD.canteen AND count <= 0;
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {schema}.trg_requests_counts_update AFTER UPDATE OF meal_date, canteen ON requests
+    WHEN OLD.meal_date IS NOT NEW.meal_date OR OLD.canteen IS NOT NEW.canteen
+    BEGIN
+        UPDATE daily_canteen_counts SET count = count - 1
+        WHERE meal_date = OLD.meal_date AND canteen = OLD.canteen;
+        DELETE FROM daily_canteen_counts
+        WHERE meal_date = OLD.meal_date AND canteen = OLD.canteen AND count <= 0;
+        INSERT INTO daily_canteen_counts (meal_date, canteen, count) VALUES (NEW.meal_date, NEW.canteen, 1)
+        ON CONFLICT(meal_date, canteen) DO UPDATE SET count = count + 1;
+    END
+    """)
+
+
+def _migrate_v2(conn):
+    # Сводная таблица для экрана статистики: число заявок по дням и столовым
+    _create_daily_counts(conn)
+    _rebuild_daily_counts(conn)
+
+
+def _migrate_v3(conn):
+    # Сессии FSM (незавершенные диалоги подачи заявки)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_sessions (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        updated_at REAL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_fsm_sessions_updated ON fsm_sessions(updated_at)")
+
+
+def _migrate_v4(conn):
+    # Счетчик версии данных: растет при любом изменении заявок или ФИО
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+    for table in ("requests", "users"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+            END
+            """)
+
+
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4]
+
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Применена миграция схемы v{number}")
+
+
+def _attach_archive(conn, archive_name, journal_mode):
+    # Архив - отдельный файл SQLite с той же таблицей requests и своей сводкой по дням.
+    # Пользователи остаются в основной базе, архивные заявки ссылаются на users.id.
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_name,))
+    _configure(conn, "archive", journal_mode)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS archive.requests (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        meal_date DATE,
+        submission_date DATE,
+        submission_time TIME,
+        canteen TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_requests_meal_canteen ON requests(meal_date, canteen)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.ix_requests_user ON requests(user_id)")
+    _create_daily_counts(conn, "archive")
+    conn.commit()
+
+
+def _has_archive(conn):
+    return any(row[1] == "archive" for row in conn.execute("PRAGMA database_list"))
+
+
+def _get_user(conn, telegram_id):
+    cursor = conn.execute("SELECT id, full_name FROM users WHERE telegram_id = ?", (telegram_id,))
+    return cursor.fetchone()
+
+
+def _recent_users(conn, limit):
+    cursor = conn.execute(
+        "SELECT id, telegram_id, full_name FROM users ORDER BY last_update DESC, id DESC LIMIT ?", (limit,))
+    return cursor.fetchall()
+
+
+def _save_user(conn, telegram_id, full_name, today):
+    # Возвращает id пользователя в таблице users
+    cursor = conn.cursor()
+    try:
+        # Проверяем существование пользователя
+        cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+        user = cursor.fetchone()
+        if user:
+            # Обновляем существующего пользователя
+            cursor.execute(
+                "UPDATE users SET full_name = ?, last_update = ? WHERE telegram_id = ?",
+                (full_name, today, telegram_id))
+            user_id = user[0]
+        else:
+            # Добавляем нового пользователя
+            cursor.execute(
+                "INSERT INTO users (telegram_id, full_name, last_update) VALUES (?, ?, ?)",
+                (telegram_id, full_name, today))
+            user_id = cursor.lastrowid
+        conn.commit()
+        return user_id
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _delete_user(conn, telegram_id):
+    cursor = conn.cursor()
+    try:
+        # Удаляем заявки пользователя, в том числе архивные
+        cursor.execute("DELETE FROM requests WHERE user_id IN (SELECT id FROM users WHERE telegram_id = ?)", (telegram_id,))
+        if _has_archive(conn):
+            cursor.execute(
+                "DELETE FROM archive.requests WHERE user_id IN (SELECT id FROM main.users WHERE telegram_id = ?)",
+                (telegram_id,))
+        # Удаляем самого пользователя
+        cursor.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
+        conn.commit()
+        return cursor.rowcount
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _upsert_request(conn, user_id, meal_date, canteen, submission_date, submission_time):
+    # Возвращает "подана" для новой заявки и "обновлена" для существующей.
+    # Вставка и обновление идут в одной транзакции по уникальному индексу (user_id, meal_date) -
+    # без гонки двойного нажатия. Признак новой заявки - rowcount вставки, а не last_insert_rowid:
+    # тот общий для подключения и меняется при вставке пользователей.
+    try:
+        cursor = conn.execute("""
+        INSERT INTO requests (user_id, meal_date, submission_date, submission_time, canteen)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, meal_date) DO NOTHING
+        """, (user_id, meal_date, submission_date, submission_time, canteen))
+        inserted = cursor.rowcount > 0
+        if not inserted:
+            conn.execute("""
+            UPDATE requests SET canteen = ?, submission_date = ?, submission_time = ?
+            WHERE user_id = ? AND meal_date = ?
+            """, (canteen, submission_date, submission_time, user_id, meal_date))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return "подана" if inserted else "обновлена"
+
+
+def _get_user_requests(conn, user_id, date_from, date_to):
+    # Заявки пользователя за период: {meal_date: canteen}
+    cursor = conn.execute(
+        "SELECT meal_date, canteen FROM requests WHERE user_id = ? AND meal_date BETWEEN ? AND ?",
+        (user_id, date_from, date_to))
+    return dict(cursor.fetchall())
+
+
+def _save_week_plan(conn, user_id, plan, removed, submission_date, submission_time):
+    # Все заявки недели одной транзакцией: пачка UPSERT и удаление снятых дней
+    try:
+        conn.executemany("""
+        INSERT INTO requests (user_id, meal_date, submission_date, submission_time, canteen)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, meal_date) DO UPDATE SET
+            canteen = excluded.canteen,
+            submission_date = excluded.submission_date,
+            submission_time = excluded.submission_time
+        WHERE canteen IS NOT excluded.canteen
+        """, [(user_id, meal_date, submission_date, submission_time, canteen) for meal_date, canteen in plan.items()])
+        conn.executemany(
+            "DELETE FROM requests WHERE user_id = ? AND meal_date = ?",
+            [(user_id, meal_date) for meal_date in removed])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _manifest_rows(conn, meal_date):
+    cursor = conn.execute("""
+    SELECT u.id, u.full_name, r.canteen
+    FROM requests r
+    JOIN users u ON u.id = r.user_id
+    WHERE r.meal_date = ?
+    """, (meal_date,))
+    return cursor.fetchall()
+
+
+def _clear_all(conn):
+    try:
+        conn.execute("DELETE FROM requests")
+        if _has_archive(conn):
+            conn.execute("DELETE FROM archive.requests")
+        conn.execute("DELETE FROM users")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _count_stats(conn, history=False):
+    # Читает только сводные таблицы daily_canteen_counts - стоимость O(дней), а не O(заявок).
+    # С history=True к рабочей сводке добавляется сводка архива.
+    counts = "main.daily_canteen_counts"
+    if history:
+        # Заявка, уже скопированная в архив, но еще не удаленная из рабочей таблицы, учтена в обеих
+        # сводках - вычитаем такие строки. Они могут быть только среди дат, которые есть в архиве,
+        # поэтому поиск идет по индексу (meal_date, canteen) в узком диапазоне.
+        counts = """(
+            SELECT * FROM main.daily_canteen_counts
+            UNION ALL SELECT * FROM archive.daily_canteen_counts
+            UNION ALL SELECT m.meal_date, m.canteen, -COUNT(*) FROM main.requests m
+            WHERE m.meal_date <= (SELECT MAX(meal_date) FROM archive.daily_canteen_counts)
+              AND EXISTS (SELECT 1 FROM archive.requests a WHERE a.id = m.id)
+            GROUP BY m.meal_date, m.canteen
+        )"""
+    cursor = conn.cursor()
+
+    # Количество пользователей
+    cursor.execute("SELECT COUNT(*) FROM users")
+    users_count = cursor.fetchone()[0]
+
+    # Количество заявок
+    cursor.execute(f"SELECT COALESCE(SUM(count), 0) FROM {counts}")
+    requests_count = cursor.fetchone()[0]
+
+    # Последняя заявка
+    cursor.execute(f"SELECT MAX(meal_date) FROM {counts}")
+    last_meal_date = cursor.fetchone()[0]
+
+    # Статистика по столовым
+    cursor.execute(f"SELECT canteen, SUM(count) FROM {counts} GROUP BY canteen")
+    canteen_stats = cursor.fetchall()
+
+    # Статистика по датам
+    cursor.execute(f"SELECT meal_date, SUM(count) FROM {counts} GROUP BY meal_date ORDER BY meal_date DESC LIMIT 7")
+    date_stats = cursor.fetchall()
+
+    stats = {
+        "users": users_count,
+        "requests": requests_count,
+        "last_meal_date": last_meal_date,
+        "canteens": canteen_stats,
+        "dates": date_stats,
+    }
+    if history:
+        cursor.execute(f"SELECT MIN(meal_date) FROM {counts}")
+        stats["first_meal_date"] = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM archive.daily_canteen_counts")
+        stats["archived"] = cursor.fetchone()[0]
+    return stats
+
+
+def _data_version(conn):
+    return conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+
+
+def _archive_batch(conn, before, limit):
+    # Переносит до limit самых старых заявок с датой питания раньше before.
+    # Индекс (meal_date, canteen) отдает строки уже по порядку дат - без сортировки.
+    # В WAL транзакция над двумя файлами не атомарна, поэтому сначала фиксируется копия
+    # в архиве, затем удаление; повтор после сбоя пропускает уже перенесенные id.
+    ids = conn.execute(
+        "SELECT id FROM main.requests WHERE meal_date < ? ORDER BY meal_date LIMIT ?", (before, limit)).fetchall()
+    if not ids:
+        return 0
+    try:
+        conn.executemany("""
+        INSERT OR IGNORE INTO archive.requests (id, user_id, meal_date, submission_date, submission_time, canteen)
+        SELECT id, user_id, meal_date, submission_date, submission_time, canteen FROM main.requests WHERE id = ?
+        """, ids)
+        conn.commit()
+        conn.executemany("DELETE FROM main.requests WHERE id = ?", ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ids)
+
+
+def _hot_excess(conn, max_rows):
+    # На сколько рабочая таблица превышает лимит (по сводке, без COUNT(*) по заявкам)
+    total = conn.execute("SELECT COALESCE(SUM(count), 0) FROM main.daily_canteen_counts").fetchone()[0]
+    return total - max_rows
+
+
+def _checkpoint(conn, mode):
+    # Возвращает (занято, страниц в WAL, перенесено)
+    return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+
+def _rebuild_daily_counts(conn, schema="main"):
+    # Пересчитывает сводку с нуля; возвращает число строк, которые расходились с requests
+    mismatched = conn.execute(f"""
+    WITH actual AS (
+        SELECT meal_date, canteen, COUNT(*) AS count FROM {schema}.requests GROUP BY meal_date, canteen
+    )
+    SELECT
+        (SELECT COUNT(*) FROM (SELECT * FROM actual EXCEPT SELECT * FROM {schema}.daily_canteen_counts))
+        + (SELECT COUNT(*) FROM (SELECT * FROM {schema}.daily_canteen_counts EXCEPT SELECT * FROM actual))
+    """).fetchone()[0]
+    conn.execute(f"DELETE FROM {schema}.daily_canteen_counts")
+    conn.execute(f"""
+    INSERT INTO {schema}.daily_canteen_counts (meal_date, canteen, count)
+    SELECT meal_date, canteen, COUNT(*) FROM {schema}.requests GROUP BY meal_date, canteen
+    """)
+    return mismatched
+
+
+def _rebuild_stats(conn):
+    # Сводки основной базы и архива (его читает статистика за все время)
+    try:
+        mismatched = _rebuild_daily_counts(conn)
+        if _has_archive(conn):
+            mismatched += _rebuild_daily_counts(conn, "archive")
+        conn.commit()
+        return mismatched
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _users_page(conn, after, limit):
+    return conn.execute(
+        "SELECT id, telegram_id, full_name FROM users WHERE id > ? ORDER BY id LIMIT ?", (after, limit)).fetchall()
+
+
+def _users_without_request_page(conn, after, limit, meal_date):
+    # Анти-джойн вместо отдельного запроса на каждого пользователя
+    return conn.execute("""
+    SELECT u.id, u.telegram_id, u.full_name
+    FROM users u
+    WHERE u.id > ? AND NOT EXISTS (
+        SELECT 1 FROM requests r WHERE r.user_id = u.id AND r.meal_date = ?
+    )
+    ORDER BY u.id
+    LIMIT ?
+    """, (after, meal_date, limit)).fetchall()
+
+
+def _get_fsm_session(conn, key):
+    return conn.execute("SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?", (key,)).fetchone()
+
+
+def _save_fsm_sessions(conn, rows):
+    # rows: (key, state, data_json, updated_at); пустые сессии удаляются
+    empty = [(key,) for key, state, data, _ in rows if state is None and data == "{}"]
+    filled = [row for row in rows if not (row[1] is None and row[2] == "{}")]
+    try:
+        conn.executemany("DELETE FROM fsm_sessions WHERE key = ?", empty)
+        conn.executemany("""
+        INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+        """, filled)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _evict_fsm_sessions(conn, before):
+    try:
+        cursor = conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (before,))
+        conn.commit()
+        return cursor.rowcount
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1,452 @@
+import asyncio
+import contextlib
+import csv
+import gzip
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from db import BUSY_TIMEOUT, PRAGMAS
+
+logger = logging.getLogger(__name__)
+
+# Через сколько строк сообщаем о прогрессе
+PROGRESS_EVERY = 20000
+# Сколько строк читаем из курсора за раз
+FETCH_SIZE = 5000
+
+# Степень сжатия gzip: 6 почти не уступает 9 по размеру и заметно быстрее
+GZIP_LEVEL = 6
+
+# Сколько секунд без обращений живет снимок базы для отчетов администратора
+SNAPSHOT_TTL = 10 * 60
+
+# Ограничения папки с отчетами: старые файлы удаляются по LRU
+REPORTS_MAX_FILES = 20
+REPORTS_MAX_BYTES = 200 * 1024 * 1024
+
+HEADERS = ["ФИО", "Дата питания", "Дата и время подачи", "Столовая"]
+COLUMN_WIDTHS = {"A": 30, "B": 15, "C": 20, "D": 15}
+SUMMARY_COLUMN_WIDTH = 15
+
+# Даты форматируются прямо в SQLite - в Python строки не разбираются.
+# {requests} - рабочая таблица или объединение с архивом.
+EXPORT_QUERY = """
+SELECT
+    u.full_name,
+    strftime('%d.%m.%Y', r.meal_date),
+    strftime('%d.%m.%Y', r.submission_date) || ' ' || r.submission_time,
+    r.canteen
+FROM {requests} r
+JOIN users u ON u.id = r.user_id
+ORDER BY r.meal_date DESC, u.full_name
+"""
+
+# Сводка день x столовая: один GROUP BY по дате с условной суммой на каждую столовую.
+# Читает только индекс (meal_date, canteen) - стоимость почти не зависит от числа строк в листе заявок.
+CANTEENS_QUERY = "SELECT DISTINCT canteen FROM {requests} ORDER BY canteen"
+SUMMARY_QUERY = """
+SELECT strftime('%d.%m.%Y', meal_date), {columns}, COUNT(*)
+FROM {requests}
+GROUP BY meal_date
+ORDER BY meal_date DESC
+"""
+
+# Выгрузки для скриптов: даты в ISO, строка JSON собирается в SQLite
+CSV_QUERY = """
+SELECT
+    u.full_name,
+    r.meal_date,
+    r.submission_date || ' ' || r.submission_time,
+    r.canteen
+FROM {requests} r
+JOIN users u ON u.id = r.user_id
+ORDER BY r.meal_date DESC, u.full_name
+"""
+JSONL_QUERY = """
+SELECT json_object(
+    'full_name', u.full_name,
+    'meal_date', r.meal_date,
+    'submitted_at', r.submission_date || 'T' || r.submission_time,
+    'canteen', r.canteen
+)
+FROM {requests} r
+JOIN users u ON u.id = r.user_id
+ORDER BY r.meal_date DESC, u.full_name
+"""
+
+REQUEST_COLUMNS = "user_id, meal_date, submission_date, submission_time, canteen"
+# Перенос в архив фиксирует копию раньше удаления, поэтому заявка может быть в обоих файлах:
+# из рабочей таблицы берутся только строки, которых еще нет в архиве (поиск по первичному ключу)
+NOT_ARCHIVED = "NOT EXISTS (SELECT 1 FROM archive.requests a WHERE a.id = main.requests.id)"
+
+
+# Фильтр выгрузки: период дат питания (включительно) и столовая; None - без ограничения
+class ExportFilter:
+    def __init__(self, date_from=None, date_to=None, canteen=None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.canteen = canteen
+
+    def where(self):
+        # Условия идут по индексу (meal_date, canteen): диапазон дат, затем столовая
+        clauses = []
+        params = []
+        if self.date_from:
+            clauses.append("meal_date >= ?")
+            params.append(self.date_from.isoformat())
+        if self.date_to:
+            clauses.append("meal_date <= ?")
+            params.append(self.date_to.isoformat())
+        if self.canteen:
+            clauses.append("canteen = ?")
+            params.append(self.canteen)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def key(self):
+        return f"{self.date_from or ''}:{self.date_to or ''}:{self.canteen or ''}"
+
+    def describe(self):
+        if self.date_from or self.date_to:
+            date_from = self.date_from.strftime("%d.%m.%Y") if self.date_from else "…"
+            date_to = self.date_to.strftime("%d.%m.%Y") if self.date_to else "…"
+            period = date_from if self.date_from == self.date_to else f"{date_from} – {date_to}"
+        else:
+            period = "всё время"
+        return f"период: {period}, столовая: {self.canteen or 'все'}"
+
+
+def _connect(db_name, archive_name=None, export_filter=None):
+    # Подключение для выгрузки. Возвращает (подключение, источник заявок, параметры):
+    # рабочая таблица или объединение с архивом; фильтр применяется в каждой ветке,
+    # чтобы обе таблицы читались по индексу только в нужном диапазоне.
+    # База в WAL, поэтому долгое чтение не мешает боту записывать заявки.
+    conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT)
+    conn.execute(f"PRAGMA mmap_size = {PRAGMAS['mmap_size']}")
+    tables = ["main.requests"]
+    if archive_name and os.path.exists(archive_name):
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_name,))
+        if conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'requests'").fetchone():
+            tables.append("archive.requests")
+    where, params = export_filter.where() if export_filter else ("", [])
+    if len(tables) == 1:
+        if not where:
+            return conn, tables[0], []
+        return conn, f"(SELECT {REQUEST_COLUMNS} FROM {tables[0]}{where})", params
+    hot_where = f"{where} AND {NOT_ARCHIVED}" if where else f" WHERE {NOT_ARCHIVED}"
+    source = (f"SELECT {REQUEST_COLUMNS} FROM main.requests{hot_where} "
+              f"UNION ALL SELECT {REQUEST_COLUMNS} FROM archive.requests{where}")
+    return conn, f"({source})", params * 2
+
+
+def _iter_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def count_export_rows(db_name, archive_name=None, export_filter=None):
+    conn, requests, params = _connect(db_name, archive_name, export_filter)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {requests} r JOIN users u ON u.id = r.user_id", params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _header_row(ws, titles):
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment
+
+    bold_font = Font(bold=True)
+    center_alignment = Alignment(horizontal='center')
+    header = []
+    for title in titles:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = bold_font
+        cell.alignment = center_alignment
+        header.append(cell)
+    return header
+
+
+def _write_summary(wb, conn, requests, params):
+    # Лист "Сводка": строка на день, столбец на столовую и итог; последняя строка - итоги по столовым
+    canteens = [row[0] for row in conn.execute(CANTEENS_QUERY.format(requests=requests), params)]
+    ws = wb.create_sheet("Сводка")
+    ws.column_dimensions["A"].width = SUMMARY_COLUMN_WIDTH
+    ws.append(_header_row(ws, ["Дата питания"] + canteens + ["Всего"]))
+    if not canteens:
+        return 0
+
+    columns = ", ".join("SUM(canteen = ?)" for _ in canteens)
+    query = SUMMARY_QUERY.format(columns=columns, requests=requests)
+    totals = [0] * (len(canteens) + 1)
+    days = 0
+    for row in _iter_rows(conn.execute(query, canteens + params)):
+        ws.append(row)
+        for index, value in enumerate(row[1:]):
+            totals[index] += value
+        days += 1
+    ws.append(_header_row(ws, ["Итого"] + totals))
+    return days
+
+
+def write_excel(db_name, path, progress=None, archive_name=None, export_filter=None, summary=True):
+    # Потоковая выгрузка заявок в xlsx (write_only): память не зависит от числа строк.
+    # С archive_name в выгрузку попадают и архивные заявки, export_filter ограничивает выборку.
+    # Первый лист - сводка по дням и столовым, второй - сами заявки.
+    # Выполняется в рабочем потоке со своим подключением; progress(n) вызывается из этого потока.
+    # openpyxl импортируется при первой выгрузке, чтобы не замедлять запуск бота.
+    from openpyxl import Workbook
+
+    conn, requests, params = _connect(db_name, archive_name, export_filter)
+    try:
+        wb = Workbook(write_only=True)
+        if summary:
+            _write_summary(wb, conn, requests, params)
+
+        ws = wb.create_sheet("Заявки")
+        for column, width in COLUMN_WIDTHS.items():
+            ws.column_dimensions[column].width = width
+
+        # Заголовки
+        ws.append(_header_row(ws, HEADERS))
+
+        written = 0
+        for row in _iter_rows(conn.execute(EXPORT_QUERY.format(requests=requests), params)):
+            ws.append(row)
+            written += 1
+            if progress and written % PROGRESS_EVERY == 0:
+                progress(written)
+
+        wb.save(path)
+        logger.info(f"Excel-файл сохранен: {path} ({written} записей)")
+        return written
+    finally:
+        conn.close()
+
+
+def _write_gzip(db_name, query, make_writer, progress, archive_name, export_filter):
+    # Строки идут из курсора пачками прямо в gzip в памяти - целиком не материализуются.
+    # make_writer(text) пишет заголовок и возвращает функцию записи пачки строк.
+    # Возвращает (сжатые байты, число строк) для загрузки в Telegram без временного файла.
+    conn, requests, params = _connect(db_name, archive_name, export_filter)
+    try:
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=GZIP_LEVEL) as compressed:
+            with io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+                write_rows = make_writer(text)
+                cursor = conn.execute(query.format(requests=requests), params)
+                written = 0
+                while True:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    write_rows(rows)
+                    reported = written // PROGRESS_EVERY
+                    written += len(rows)
+                    if progress and written // PROGRESS_EVERY > reported:
+                        progress(written)
+        return buffer.getvalue(), written
+    finally:
+        conn.close()
+
+
+def _csv_writer(text):
+    writer = csv.writer(text)
+    writer.writerow(HEADERS)
+    return writer.writerows
+
+
+def _jsonl_writer(text):
+    return lambda rows: text.writelines(f"{row[0]}\n" for row in rows)
+
+
+def write_csv_gz(db_name, progress=None, archive_name=None, export_filter=None):
+    data, written = _write_gzip(db_name, CSV_QUERY, _csv_writer, progress, archive_name, export_filter)
+    logger.info(f"CSV.gz сформирован в памяти: {len(data)} байт ({written} записей)")
+    return data, written
+
+
+def write_jsonl_gz(db_name, progress=None, archive_name=None, export_filter=None):
+    data, written = _write_gzip(db_name, JSONL_QUERY, _jsonl_writer, progress, archive_name, export_filter)
+    logger.info(f"JSONL.gz сформирован в памяти: {len(data)} байт ({written} записей)")
+    return data, written
+
+
+# Снимок базы на момент времени: отчеты строятся по копии и не держат чтение в рабочей базе
+class Snapshot:
+    def __init__(self, path, archive_path, version):
+        self.path = path
+        self.archive_path = archive_path
+        self.version = version
+        self.created = datetime.now()
+        self.last_used = time.monotonic()
+        self.users = 0
+        self.retired = False
+        # Таймер удаления копии после простоя
+        self.expiry = None
+
+    def close(self):
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        for path in (self.path, self.archive_path):
+            if path:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+
+def take_snapshot(db_name, archive_name=None, folder=None):
+    # Копия базы (и архива) через online backup API. Обе копии снимаются в одной
+    # читающей транзакции, поэтому согласованы между собой; в WAL запись заявок не ждет.
+    paths = []
+    src = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT)
+    try:
+        schemas = ["main"]
+        if archive_name and os.path.exists(archive_name):
+            src.execute("ATTACH DATABASE ? AS archive", (archive_name,))
+            schemas.append("archive")
+        src.execute("BEGIN")
+        version = src.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+        if len(schemas) > 1:
+            # Читающая транзакция начинается в каждом файле при первом обращении к нему:
+            # фиксируем и архив сразу, иначе его копия сняла бы более позднее состояние
+            src.execute("SELECT 1 FROM archive.sqlite_master LIMIT 1").fetchone()
+        for schema in schemas:
+            fd, path = tempfile.mkstemp(prefix=f"snapshot_{schema}_", suffix=".db", dir=folder)
+            os.close(fd)
+            paths.append(path)
+            dst = sqlite3.connect(path)
+            try:
+                src.backup(dst, name=schema)
+                # Копия только читается - обычный журнал вместо WAL
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+        src.rollback()
+    except Exception:
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        raise
+    finally:
+        src.close()
+    snapshot = Snapshot(paths[0], paths[1] if len(paths) > 1 else None, version)
+    logger.info(f"Снимок базы создан (версия данных {version}): {paths[0]}")
+    return snapshot
+
+
+# Снимки по владельцам (сессия администратора): несколько отчетов подряд строятся по одной копии.
+# Архив копируется только для выгрузок с историей: он растет без ограничений, а обычному
+# отчету за завтра не нужен.
+class SnapshotRegistry:
+    def __init__(self, db_name, archive_name=None, folder=None, ttl=SNAPSHOT_TTL):
+        self.db_name = db_name
+        self.archive_name = archive_name
+        self.folder = folder
+        self.ttl = ttl
+        self._snapshots = {}
+        self._lock = asyncio.Lock()
+
+    def _retire(self, key):
+        snapshot = self._snapshots.pop(key)
+        snapshot.retired = True
+        if snapshot.users == 0:
+            snapshot.close()
+
+    def _expire(self, key, snapshot):
+        if self._snapshots.get(key) is snapshot and snapshot.users == 0:
+            logger.info(f"Снимок базы удален после простоя: {snapshot.path}")
+            self._retire(key)
+
+    def _schedule_expiry(self, key, snapshot):
+        # Копия удаляется через ttl после последнего отчета, даже если новых выгрузок не будет
+        if snapshot.expiry is not None:
+            snapshot.expiry.cancel()
+        snapshot.expiry = asyncio.get_running_loop().call_later(self.ttl, self._expire, key, snapshot)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key, snapshot in list(self._snapshots.items()):
+            if snapshot.users == 0 and now - snapshot.last_used > self.ttl:
+                self._retire(key)
+
+    @contextlib.asynccontextmanager
+    async def use(self, owner, history=False, fresh=False):
+        # Отдает снимок владельца (history=True - вместе с архивом); fresh=True - снять заново,
+        # остальные снимки владельца при этом тоже устаревают
+        key = (owner, history)
+        async with self._lock:
+            self._evict_expired()
+            if fresh:
+                for other in [other for other in self._snapshots if other[0] == owner]:
+                    self._retire(other)
+            snapshot = self._snapshots.get(key)
+            if snapshot is None:
+                archive_name = self.archive_name if history else None
+                snapshot = await asyncio.to_thread(take_snapshot, self.db_name, archive_name, self.folder)
+                self._snapshots[key] = snapshot
+            snapshot.users += 1
+        try:
+            yield snapshot
+        finally:
+            snapshot.users -= 1
+            snapshot.last_used = time.monotonic()
+            if snapshot.retired and snapshot.users == 0:
+                snapshot.close()
+            elif snapshot.users == 0:
+                self._schedule_expiry(key, snapshot)
+
+    def close(self):
+        for key in list(self._snapshots):
+            self._retire(key)
+
+
+# Кэш готовых выгрузок: для неизменившихся данных повторно отправляется file_id Telegram
+class ExportCache:
+    def __init__(self):
+        # ключ выгрузки -> (версия данных, file_id, подпись)
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        return None
+
+    def put(self, key, version, file_id, caption):
+        self._entries[key] = (version, file_id, caption)
+
+
+def prune_reports(folder, max_files=REPORTS_MAX_FILES, max_bytes=REPORTS_MAX_BYTES):
+    # Удаляет давно не использованные отчеты, пока папка не уложится в лимиты
+    files = []
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            stat = entry.stat()
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    while files and (len(files) > max_files or total > max_bytes):
+        _, size, path = files.pop(0)
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить отчет {path}: {e}")
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logger.info(f"Удалено старых отчетов: {removed}")
+    return removed
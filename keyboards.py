@@ -0,0 +1,178 @@
+import calendar
+from datetime import date, timedelta
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import KeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+
+# Тексты кнопок
+BTN_ORDER = "🍽 Подать заявку"
+BTN_WEEK_PLAN = "📅 План на неделю"
+BTN_CHANGE_NAME = "✏️ Изменить ФИО"
+BTN_DELETE_ME = "❌ Удалить мои данные"
+BTN_STATS = "📊 Статистика"
+BTN_EXPORT = "📥 Экспорт в Excel"
+BTN_CLEAR_DB = "🧹 Очистить базу"
+BTN_MANIFEST = "🧾 Список для кухни"
+BTN_BACK = "↩️ Назад"
+
+CANTEENS = ["Центр", "Ястреб"]
+# На сколько дней вперед можно подать заявку с клавиатуры
+ORDER_DAYS_AHEAD = 3
+DATE_FORMAT = "%d.%m.%Y"
+# Сколько дней охватывает планировщик на неделю
+PLAN_DAYS = 7
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+# Форматы выгрузки: код -> текст кнопки
+EXPORT_FORMATS = {"xlsx": "📊 Excel", "csv": "🗜 CSV.gz", "jsonl": "🗜 JSONL.gz"}
+# Периоды выгрузки по дате питания; "custom" - свой период, который вводит администратор
+EXPORT_PERIODS = {"tomorrow": "Завтра", "week": "Неделя", "month": "Месяц", "all": "Всё время"}
+
+
+# Данные кнопок планировщика: действие, день (ISO) и номер столовой в CANTEENS
+class PlanCallback(CallbackData, prefix="plan"):
+    action: str
+    day: str = ""
+    canteen: int = -1
+
+
+# Данные кнопок экрана выгрузки: действие, выбранные формат, период и столовая.
+# Для своего периода границы передаются в ISO.
+class ExportCallback(CallbackData, prefix="export"):
+    action: str
+    fmt: str = ""
+    history: bool = False
+    period: str = "all"
+    canteen: int = -1
+    date_from: str = ""
+    date_to: str = ""
+
+
+def _build_main_menu(is_admin):
+    builder = ReplyKeyboardBuilder()
+    builder.add(KeyboardButton(text=BTN_ORDER))
+    builder.add(KeyboardButton(text=BTN_WEEK_PLAN))
+    builder.add(KeyboardButton(text=BTN_CHANGE_NAME))
+    builder.add(KeyboardButton(text=BTN_DELETE_ME))
+
+    if is_admin:
+        builder.add(KeyboardButton(text=BTN_STATS))
+        builder.add(KeyboardButton(text=BTN_EXPORT))
+        builder.add(KeyboardButton(text=BTN_MANIFEST))
+        builder.add(KeyboardButton(text=BTN_CLEAR_DB))
+
+    builder.adjust(2, 2, 2, 2)
+    return builder.as_markup(resize_keyboard=True)
+
+
+def _build_canteen_keyboard():
+    builder = ReplyKeyboardBuilder()
+    for canteen in CANTEENS:
+        builder.add(KeyboardButton(text=canteen))
+    builder.add(KeyboardButton(text=BTN_BACK))
+    builder.adjust(2, 1)
+    return builder.as_markup(resize_keyboard=True)
+
+
+def meal_dates(today=None):
+    # Даты, которые предлагаются для заявки: завтра и следующие дни
+    today = today or date.today()
+    return [today + timedelta(days=n) for n in range(1, ORDER_DAYS_AHEAD + 1)]
+
+
+def _build_date_keyboard(today):
+    builder = ReplyKeyboardBuilder()
+    for d in meal_dates(today):
+        builder.add(KeyboardButton(text=d.strftime(DATE_FORMAT)))
+    builder.add(KeyboardButton(text=BTN_BACK))
+    builder.adjust(ORDER_DAYS_AHEAD, 1)
+    return builder.as_markup(resize_keyboard=True)
+
+
+# Клавиатуры неизменяемы, поэтому строятся один раз и используются всеми обработчиками
+_MAIN_MENUS = {False: _build_main_menu(False), True: _build_main_menu(True)}
+CANTEEN_KEYBOARD = _build_canteen_keyboard()
+_date_keyboard = (None, None)
+
+
+def main_menu(is_admin=False):
+    return _MAIN_MENUS[bool(is_admin)]
+
+
+def date_keyboard(today=None):
+    # Клавиатура дат пересобирается только при смене календарного дня
+    global _date_keyboard
+    today = today or date.today()
+    built_for, markup = _date_keyboard
+    if built_for != today:
+        markup = _build_date_keyboard(today)
+        _date_keyboard = (today, markup)
+    return markup
+
+
+def plan_dates(today=None):
+    # Дни, доступные в планировщике: начиная с завтрашнего
+    today = today or date.today()
+    return [today + timedelta(days=n) for n in range(1, PLAN_DAYS + 1)]
+
+
+def week_plan_keyboard(days, plan):
+    # Один экран на всю неделю: строка на день, отмеченная столовая помечена ✅.
+    # plan - словарь {ISO-дата: столовая}
+    builder = InlineKeyboardBuilder()
+    for d in days:
+        day = d.isoformat()
+        chosen = plan.get(day)
+        builder.button(text=f"{WEEKDAYS[d.weekday()]} {d.strftime('%d.%m')}",
+                       callback_data=PlanCallback(action="noop", day=day))
+        for index, canteen in enumerate(CANTEENS):
+            mark = "✅ " if chosen == canteen else ""
+            builder.button(text=f"{mark}{canteen}", callback_data=PlanCallback(action="set", day=day, canteen=index))
+        builder.button(text="✖️" if chosen else "—", callback_data=PlanCallback(action="clear", day=day))
+    # Одна столовая на все будни: план сохраняется этим же нажатием
+    builder.button(text="📌 Все будни", callback_data=PlanCallback(action="noop"))
+    for index, canteen in enumerate(CANTEENS):
+        builder.button(text=canteen, callback_data=PlanCallback(action="weekdays", canteen=index))
+    builder.button(text="💾 Сохранить", callback_data=PlanCallback(action="save"))
+    builder.button(text="↩️ Отмена", callback_data=PlanCallback(action="cancel"))
+    builder.adjust(*([len(CANTEENS) + 2] * len(days)), len(CANTEENS) + 1, 2)
+    return builder.as_markup()
+
+
+def period_range(period, today=None, date_from="", date_to=""):
+    # Границы периода выгрузки (включительно); (None, None) - всё время
+    today = today or date.today()
+    if period == "tomorrow":
+        tomorrow = today + timedelta(days=1)
+        return tomorrow, tomorrow
+    if period == "week":
+        monday = today - timedelta(days=today.weekday())
+        return monday, monday + timedelta(days=6)
+    if period == "month":
+        last_day = calendar.monthrange(today.year, today.month)[1]
+        return today.replace(day=1), today.replace(day=last_day)
+    if period == "custom":
+        return date.fromisoformat(date_from), date.fromisoformat(date_to)
+    return None, None
+
+
+@lru_cache(maxsize=64)
+def export_keyboard(history=False, period="all", canteen=-1, date_from="", date_to=""):
+    # Экран выгрузки: период, столовая (выбранные помечены ✅) и кнопки форматов, которые запускают выгрузку
+    state = {"history": history, "period": period, "canteen": canteen, "date_from": date_from, "date_to": date_to}
+    builder = InlineKeyboardBuilder()
+    for code, text in EXPORT_PERIODS.items():
+        mark = "✅ " if code == period else ""
+        builder.button(text=f"{mark}{text}", callback_data=ExportCallback(
+            action="period", **{**state, "period": code, "date_from": "", "date_to": ""}))
+    custom = "✅ " if period == "custom" else ""
+    builder.button(text=f"{custom}📆 Свой период", callback_data=ExportCallback(action="custom", **state))
+    for index, text in enumerate(["Все столовые"] + CANTEENS, start=-1):
+        mark = "✅ " if index == canteen else ""
+        builder.button(text=f"{mark}{text}", callback_data=ExportCallback(
+            action="canteen", **{**state, "canteen": index}))
+    for fmt, text in EXPORT_FORMATS.items():
+        builder.button(text=text, callback_data=ExportCallback(action="go", fmt=fmt, **state))
+    builder.adjust(len(EXPORT_PERIODS), 1, len(CANTEENS) + 1, len(EXPORT_FORMATS))
+    return builder.as_markup()
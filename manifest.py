@@ -0,0 +1,159 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+# Список для кухни на один день питания: кто и в какой столовой питается.
+# Строится один раз на отсечке, поздние изменения применяются к нему как дельты.
+class Manifest:
+    def __init__(self, meal_date, rows, canteens):
+        self.meal_date = meal_date
+        self.canteens = list(canteens)
+        self.built_at = datetime.now()
+        # id пользователя -> (ФИО, столовая)
+        self.entries = {user_id: (full_name, canteen) for user_id, full_name, canteen in rows}
+        # Поздние изменения: (время, ФИО, было, стало)
+        self.changes = []
+        self._rendered = None
+
+    def reload(self, rows):
+        # Новый состав списка из базы; журнал изменений сохраняется
+        self.entries = {user_id: (full_name, canteen) for user_id, full_name, canteen in rows}
+        self._rendered = None
+
+    def counts(self):
+        counts = {canteen: 0 for canteen in self.canteens}
+        for _, canteen in self.entries.values():
+            counts[canteen] = counts.get(canteen, 0) + 1
+        return counts
+
+    def apply(self, user_id, full_name, canteen):
+        # canteen=None - заявка снята. Возвращает изменение или None, если ничего не поменялось
+        old = self.entries.get(user_id)
+        old_canteen = old[1] if old else None
+        if old_canteen == canteen and (old is None or old[0] == full_name):
+            return None
+        if canteen is None:
+            self.entries.pop(user_id, None)
+        else:
+            self.entries[user_id] = (full_name, canteen)
+        self._rendered = None
+        if old_canteen == canteen:
+            # Изменилось только ФИО - в список изменений не попадает
+            return None
+        change = (datetime.now(), full_name, old_canteen, canteen)
+        self.changes.append(change)
+        return change
+
+    def render(self):
+        # Сообщения со списком (с разбивкой по лимиту Telegram); пересобираются только после изменений
+        if self._rendered is None:
+            self._rendered = _split(self._lines())
+        return self._rendered
+
+    def _lines(self):
+        counts = self.counts()
+        lines = [
+            f"🧾 Список на {self.meal_date.strftime('%d.%m.%Y')} "
+            f"(сформирован {self.built_at.strftime('%d.%m %H:%M')})",
+            "Всего: " + ", ".join(f"{canteen} - {count}" for canteen, count in counts.items()),
+        ]
+        by_canteen = {canteen: [] for canteen in counts}
+        for full_name, canteen in self.entries.values():
+            by_canteen[canteen].append(full_name)
+        for canteen, names in by_canteen.items():
+            lines.append("")
+            lines.append(f"🍽 {canteen} - {len(names)} чел.")
+            lines.extend(f"{n}. {name}" for n, name in enumerate(sorted(names), start=1))
+        if self.changes:
+            lines.append("")
+            lines.append(f"✏️ Изменений после отсечки: {len(self.changes)}")
+            lines.extend(format_change(change) for change in self.changes)
+        return lines
+
+
+def format_change(change):
+    changed_at, full_name, old, new = change
+    if old is None:
+        action = f"добавлен ({new})"
+    elif new is None:
+        action = f"снят ({old})"
+    else:
+        action = f"{old} → {new}"
+    return f"{changed_at.strftime('%H:%M')} {full_name}: {action}"
+
+
+def _split(lines):
+    chunks = []
+    current = ""
+    for line in lines:
+        line = line[:MESSAGE_LIMIT - 1]
+        if current and len(current) + len(line) + 1 > MESSAGE_LIMIT:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Кэш списков для кухни по датам питания
+class ManifestRegistry:
+    def __init__(self, db, canteens):
+        self.db = db
+        self.canteens = canteens
+        self._manifests = {}
+
+    async def build(self, meal_date):
+        # Строит список заново и кэширует его (на отсечке)
+        rows = await self.db.manifest_rows(meal_date.isoformat())
+        manifest = Manifest(meal_date, rows, self.canteens)
+        self._manifests[meal_date] = manifest
+        # Списки на прошедшие дни больше не нужны
+        for old in [day for day in self._manifests if day < meal_date]:
+            del self._manifests[old]
+        logger.info(f"Список для кухни на {meal_date} сформирован: {manifest.counts()}")
+        return manifest
+
+    def get(self, meal_date):
+        return self._manifests.get(meal_date)
+
+    async def refresh(self, meal_date):
+        # В режиме нескольких процессов изменения пользователей других воркеров есть только в базе
+        manifest = self._manifests[meal_date]
+        manifest.reload(await self.db.manifest_rows(meal_date.isoformat()))
+        return manifest
+
+    async def preview(self, meal_date):
+        # Предварительный список до отсечки: не кэшируется
+        rows = await self.db.manifest_rows(meal_date.isoformat())
+        return Manifest(meal_date, rows, self.canteens)
+
+    def apply(self, meal_date, user_id, full_name, canteen):
+        # Дельта для уже сформированного списка; до отсечки списка нет и применять нечего
+        manifest = self._manifests.get(meal_date)
+        if manifest is None:
+            return None
+        return manifest.apply(user_id, full_name, canteen)
+
+    def rename(self, user_id, full_name):
+        for manifest in self._manifests.values():
+            entry = manifest.entries.get(user_id)
+            if entry is not None:
+                manifest.apply(user_id, full_name, entry[1])
+
+    def remove_user(self, user_id):
+        # Пользователь удалил свои данные: снимаем его из всех сформированных списков
+        changes = []
+        for meal_date, manifest in self._manifests.items():
+            entry = manifest.entries.get(user_id)
+            if entry is not None:
+                changes.append((meal_date, manifest.apply(user_id, entry[0], None)))
+        return changes
+
+    def invalidate(self):
+        self._manifests.clear()
@@ -0,0 +1,198 @@
+import bisect
+import logging
+import threading
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Порт /metrics по умолчанию (воркеры - следующие за ним). 9100 и соседние порты заняты
+# известными экспортерами Prometheus (9100 - node_exporter), поэтому берем порт вне их диапазона
+METRICS_PORT = 18090
+
+
+# Счетчик с метками. Запись - одно сложение под блокировкой, текст строится только при сборе метрик.
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+# Текущее значение с метками (например, глубина очереди)
+class Gauge(Counter):
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+# Гистограмма с метками
+class Histogram:
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # метки -> [счетчики корзин..., сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {entry[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {entry[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {entry[-1]}")
+        return lines
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    parts = []
+    for name, value in key:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+# ================= Метрики бота =================
+
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Время обработки обновления по обработчику и состоянию FSM")
+UPDATE_ERRORS = Counter("bot_update_errors_total", "Ошибки в обработчиках")
+SHARD_UPDATES = Counter("bot_shard_updates_total", "Обновления, переданные фронтом воркерам")
+WORKER_RESTARTS = Counter("bot_worker_restarts_total", "Перезапуски упавших воркеров")
+THROTTLED_UPDATES = Counter("bot_throttled_updates_total", "Обновления, отброшенные ограничителем частоты и повторов")
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Время выполнения запросов к БД")
+DB_QUEUE_SECONDS = Histogram("bot_db_queue_wait_seconds", "Ожидание запроса в очереди потока БД")
+DB_WAL_BYTES = Gauge("bot_db_wal_bytes", "Размер WAL-файла базы после контрольной точки")
+TELEGRAM_REQUESTS = Counter("bot_telegram_requests_total", "Исходящие вызовы Bot API")
+TELEGRAM_ERRORS = Counter("bot_telegram_errors_total", "Ошибки исходящих вызовов Bot API")
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Время исходящих вызовов Bot API")
+OUTBOUND_DEPTH = Gauge("bot_outbound_queue_depth", "Сообщения в очереди отправки по полосам приоритета")
+OUTBOUND_WAIT_SECONDS = Histogram("bot_outbound_queue_wait_seconds", "Ожидание в очереди отправки по полосам приоритета")
+
+REGISTRY = [
+    UPDATE_SECONDS, UPDATE_ERRORS, THROTTLED_UPDATES, SHARD_UPDATES, WORKER_RESTARTS,
+    DB_QUERY_SECONDS, DB_QUEUE_SECONDS, DB_WAL_BYTES,
+    TELEGRAM_REQUESTS, TELEGRAM_ERRORS, TELEGRAM_SECONDS,
+    OUTBOUND_DEPTH, OUTBOUND_WAIT_SECONDS,
+]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Внешний middleware диспетчера: время обработки каждого обновления
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        # Имя обработчика заполняет HandlerNameMiddleware после выбора обработчика
+        labels = {"handler": "unhandled"}
+        data["metrics_labels"] = labels
+        state = data.get("raw_state") or "none"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(handler=labels["handler"], state=state)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, handler=labels["handler"], state=state)
+
+
+# Внутренний middleware: запоминает, какой обработчик выбран для обновления
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        labels = data.get("metrics_labels")
+        handler_object = data.get("handler")
+        if labels is not None and handler_object is not None:
+            labels["handler"] = getattr(handler_object.callback, "__name__", "unknown")
+        return await handler(event, data)
+
+
+# Middleware сессии бота: счетчики и время исходящих вызовов Bot API
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        TELEGRAM_REQUESTS.inc(method=name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=name)
+
+
+def setup(dp, bot):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+    bot.session.middleware(TelegramRequestMetrics())
+
+
+async def start_server(host="127.0.0.1", port=METRICS_PORT):
+    # Локальная точка сбора метрик в текстовом формате Prometheus
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Порт занят (например, node_exporter) - бот работает без точки метрик
+        logger.warning(f"Не удалось открыть точку метрик на {host}:{port}: {e}. Метрики отключены")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
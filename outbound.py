@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import multiprocessing
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram: около 30 сообщений в секунду на бота
+GLOBAL_RATE = 30
+
+# Полосы приоритета исходящих сообщений (меньше - важнее)
+INTERACTIVE = 0
+FILES = 1
+BROADCAST = 2
+LANE_NAMES = {INTERACTIVE: "interactive", FILES: "files", BROADCAST: "broadcast"}
+
+# Полоса текущей задачи; рассылки выставляют BROADCAST для своих воркеров
+current_lane = contextvars.ContextVar("outbound_lane", default=INTERACTIVE)
+
+# Отправка файлов идет во вторую полосу
+FILE_METHODS = {"SendDocument", "SendPhoto", "SendMediaGroup", "SendVideo", "SendAudio"}
+# Сколько раз интерактивный ответ или файл отправляется после RetryAfter
+# (рассылки повторяет и учитывает в отчете Broadcaster)
+RETRY_ATTEMPTS = 3
+
+
+# Глобальное ведро токенов: не больше rate отправок в секунду
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        # После RetryAfter Telegram не принимает сообщения - останавливаем всех
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Ведро токенов, общее для процессов-воркеров: состояние лежит в разделяемой памяти.
+# Лимит Telegram общий для бота, и воркер, которому сейчас нужно больше (рассылка
+# идет только из воркера 0), забирает весь свободный лимит, а не свою долю.
+class SharedTokenBucket:
+    def __init__(self, rate, capacity=None, context=multiprocessing):
+        self.rate = rate
+        self.capacity = capacity or rate
+        # [токены, время пополнения, пауза до]; передается воркерам при запуске
+        self._state = context.Array("d", [float(self.capacity), time.monotonic(), 0.0])
+
+    def pause(self, seconds):
+        with self._state.get_lock():
+            self._state[2] = max(self._state[2], time.monotonic() + seconds)
+
+    def _take(self):
+        # Берет токен и возвращает 0 или сколько секунд ждать следующей попытки
+        with self._state.get_lock():
+            tokens, updated, paused_until = self._state[:]
+            now = time.monotonic()
+            if now < paused_until:
+                return paused_until - now
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            self._state[1] = now
+            if tokens >= 1:
+                self._state[0] = tokens - 1
+                return 0
+            self._state[0] = tokens
+            return (1 - tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self._take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+# Центральная очередь исходящих вызовов Bot API с приоритетами.
+# В каждом чате вызовы выполняются строго по порядку: следующий запрос чата
+# становится доступен только после завершения предыдущего.
+class OutboundQueue:
+    def __init__(self, rate=GLOBAL_RATE):
+        self.bucket = TokenBucket(rate)
+        self._heap = []
+        self._chats = {}
+        self._active = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _push_head(self, chat_id):
+        lane, seq, _, _ = self._chats[chat_id][0]
+        heapq.heappush(self._heap, (lane, seq, chat_id))
+        self._wakeup.set()
+
+    def enqueue(self, lane, chat_id):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._scheduler())
+        future = asyncio.get_running_loop().create_future()
+        queue = self._chats.setdefault(chat_id, deque())
+        queue.append((lane, next(self._seq), future, time.perf_counter()))
+        metrics.OUTBOUND_DEPTH.inc(lane=LANE_NAMES[lane])
+        if len(queue) == 1 and chat_id not in self._active:
+            self._push_head(chat_id)
+        return future
+
+    def release(self, chat_id):
+        # Вызывается после завершения запроса - открывает очередь чата для следующего
+        self._active.discard(chat_id)
+        if self._chats.get(chat_id):
+            self._push_head(chat_id)
+        else:
+            self._chats.pop(chat_id, None)
+
+    def depth(self):
+        depth = {name: 0 for name in LANE_NAMES.values()}
+        for queue in self._chats.values():
+            for lane, _, _, _ in queue:
+                depth[LANE_NAMES[lane]] += 1
+        return depth
+
+    async def _scheduler(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            _, _, chat_id = heapq.heappop(self._heap)
+            lane, _, future, enqueued = self._chats[chat_id].popleft()
+            # Чат занят уже на время ожидания токена: иначе enqueue увидит пустую очередь
+            # и поставит в кучу следующее сообщение чата раньше, чем завершится это
+            self._active.add(chat_id)
+            metrics.OUTBOUND_DEPTH.dec(lane=LANE_NAMES[lane])
+            if future.done():
+                # Отправитель отменил ожидание
+                self.release(chat_id)
+                continue
+            await self.bucket.acquire()
+            metrics.OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - enqueued, lane=LANE_NAMES[lane])
+            if future.done():
+                self.release(chat_id)
+            else:
+                future.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# Middleware сессии бота: каждый вызов с chat_id проходит через очередь с приоритетами
+class OutboundQueueMiddleware(BaseRequestMiddleware):
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, setWebhook и т.п. не относятся к чатам и идут напрямую
+            return await make_request(bot, method)
+
+        lane = current_lane.get()
+        if lane == INTERACTIVE and type(method).__name__ in FILE_METHODS:
+            lane = FILES
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            granted = self.queue.enqueue(lane, chat_id)
+            try:
+                await granted
+            except asyncio.CancelledError:
+                if granted.done() and not granted.cancelled():
+                    self.queue.release(chat_id)
+                raise
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # Telegram не примет сообщения ни в один чат - останавливаем всю очередь
+                self.queue.bucket.pause(e.retry_after)
+                logger.warning(f"RetryAfter {e.retry_after} с для {chat_id}, очередь отправки приостановлена")
+                if lane == BROADCAST or attempt == RETRY_ATTEMPTS:
+                    raise
+            finally:
+                self.queue.release(chat_id)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд бездействия сессия FSM считается брошенной
+SESSION_TTL = 24 * 60 * 60
+# Как часто сбрасываем буфер изменений в базу
+FLUSH_INTERVAL = 1.0
+# Как часто удаляем просроченные сессии
+EVICT_INTERVAL = 60.0
+
+
+def _key(key):
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+
+
+# Хранилище FSM в SQLite: сессии переживают перезапуск, изменения пишутся в базу
+# отложенно пачками, а неактивные сессии удаляются по TTL.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl=SESSION_TTL, flush_interval=FLUSH_INTERVAL):
+        self.db = db
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # Буфер отложенной записи: ключ -> (state, data, updated_at)
+        self._pending = {}
+        self._task = None
+        self._last_evict = 0.0
+
+    def start(self):
+        # Запускает фоновый сброс буфера (нужен работающий цикл событий)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - self._last_evict >= EVICT_INTERVAL:
+                    self._last_evict = time.time()
+                    evicted = await self.db.evict_fsm_sessions(time.time() - self.ttl)
+                    if evicted:
+                        logger.info(f"Удалено просроченных сессий FSM: {evicted}")
+            except Exception as e:
+                logger.error(f"Ошибка записи сессий FSM: {e}", exc_info=True)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        rows = [(key, state, json.dumps(data, ensure_ascii=False), updated_at)
+                for key, (state, data, updated_at) in batch.items()]
+        try:
+            await self.db.save_fsm_sessions(rows)
+        except Exception:
+            # Возвращаем в буфер то, что не перезаписали за время записи
+            for key, entry in batch.items():
+                self._pending.setdefault(key, entry)
+            raise
+
+    async def _load(self, key):
+        entry = self._pending.get(key)
+        if entry is not None:
+            return entry[0], entry[1]
+        row = await self.db.get_fsm_session(key)
+        if row is None or row[2] < time.time() - self.ttl:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    async def set_state(self, key, state=None):
+        key = _key(key)
+        _, data = await self._load(key)
+        self._pending[key] = (state.state if isinstance(state, State) else state, data, time.time())
+
+    async def get_state(self, key):
+        state, _ = await self._load(_key(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = _key(key)
+        state, _ = await self._load(key)
+        self._pending[key] = (state, dict(data), time.time())
+
+    async def get_data(self, key):
+        _, data = await self._load(_key(key))
+        return dict(data)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -0,0 +1,48 @@
+import asyncio
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message
+
+from outbound import OutboundQueue, OutboundQueueMiddleware, TokenBucket
+
+
+# Сессия без сети: запоминает начало и конец каждого запроса
+class FakeSession(BaseSession):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.log = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.log.append(("start", method.chat_id, method.text))
+        await asyncio.sleep(self.delay)
+        self.log.append(("end", method.chat_id, method.text))
+        return Message.model_validate(
+            {"message_id": 1, "date": 0, "chat": {"id": method.chat_id, "type": "private"}},
+            context={"bot": bot})
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def test_chat_order_with_empty_bucket():
+    # Ведро пустое после сообщения в другой чат: пока первое сообщение чата ждет токен,
+    # второе сообщение того же чата не должно обогнать его или отправиться одновременно
+    async def run():
+        session = FakeSession(delay=0.3)
+        bot = Bot("1:test", session=session)
+        queue = OutboundQueue()
+        queue.bucket = TokenBucket(5, capacity=1)
+        bot.session.middleware(OutboundQueueMiddleware(queue))
+        first = asyncio.gather(bot.send_message(2, "a"), bot.send_message(1, "b"))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(first, bot.send_message(1, "c"))
+        await queue.close()
+        return [entry for entry in session.log if entry[1] == 1]
+
+    log = asyncio.run(run())
+    assert log == [("start", 1, "b"), ("end", 1, "b"), ("start", 1, "c"), ("end", 1, "c")]
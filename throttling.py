@@ -0,0 +1,100 @@
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ведро токенов на пользователя: до USER_BURST обновлений подряд, дальше USER_RATE в секунду
+USER_RATE = 2.0
+USER_BURST = 10
+# Повтор того же сообщения или нажатия в пределах окна считается двойным нажатием
+DEDUP_WINDOW = 1.0
+# Сколько пользователей отслеживаем одновременно
+MAX_TRACKED_USERS = 10000
+THROTTLE_NOTICE = "⏳ Слишком много запросов, подождите пару секунд."
+
+
+def _fingerprint(update):
+    # Тип события и отпечаток для поиска повторов (None - повторы не ищем)
+    if update.message is not None:
+        message = update.message
+        return "message", (message.chat.id, message.text) if message.text else None
+    if update.callback_query is not None:
+        callback = update.callback_query
+        message_id = callback.message.message_id if callback.message else None
+        return "callback_query", (message_id, callback.data)
+    return update.event_type, None
+
+
+# Внешний middleware диспетчера: ограничивает частоту обновлений от одного пользователя
+# и отбрасывает двойные нажатия до обработчиков и базы данных
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, dedup_window=DEDUP_WINDOW,
+                 exempt=(), maxsize=MAX_TRACKED_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_window = dedup_window
+        self.exempt = set(exempt)
+        self.maxsize = maxsize
+        # telegram_id -> [токены, время пополнения, отпечаток последнего обновления, его время, предупрежден]
+        self._users = OrderedDict()
+
+    def check(self, user_id, fingerprint, now=None):
+        # Возвращает (причина, предупредить): причина None - обновление пропускается
+        now = time.monotonic() if now is None else now
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = [float(self.burst), now, None, 0.0, False]
+            if len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+
+        if fingerprint is not None and fingerprint == entry[2] and now - entry[3] < self.dedup_window:
+            # Окно сдвигается: пока пользователь жмет ту же кнопку, повторы отбрасываются
+            entry[3] = now
+            return "duplicate", False
+
+        entry[0] = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+        entry[1] = now
+        if entry[0] < 1:
+            # Предупреждаем один раз, пока пользователь не уложится в лимит
+            notify = not entry[4]
+            entry[4] = True
+            return "rate", notify
+        entry[0] -= 1
+        entry[2], entry[3], entry[4] = fingerprint, now, False
+        return None, False
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        kind, fingerprint = _fingerprint(event)
+        reason, notify = self.check(user.id, fingerprint)
+        if reason is None:
+            return await handler(event, data)
+
+        metrics.THROTTLED_UPDATES.inc(reason=reason, event=kind)
+        try:
+            if event.callback_query is not None:
+                # Нажатие нужно подтвердить, иначе у пользователя будут крутиться часики на кнопке
+                await event.callback_query.answer(THROTTLE_NOTICE if notify else None)
+            elif notify and event.message is not None:
+                await event.message.answer(THROTTLE_NOTICE)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить на отброшенное обновление {event.update_id}: {e}")
+        return None
+
+
+def setup(dp, throttling):
+    # Ограничитель встает перед FSM: отброшенные обновления не читают состояние из базы
+    # и не ждут блокировку сессии пользователя. Вызывать до metrics.setup.
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(throttling)
+    dp.update.outer_middleware(dp.fsm)
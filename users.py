@@ -0,0 +1,66 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей держим в кэше
+USER_CACHE_SIZE = 10000
+
+
+# Реестр пользователей: LRU-кэш telegram_id -> (id, full_name, is_admin) поверх базы данных
+class UserRegistry:
+    def __init__(self, db, admin_id, maxsize=USER_CACHE_SIZE):
+        self.db = db
+        self.admin_id = admin_id
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, telegram_id, entry):
+        self._cache[telegram_id] = entry
+        self._cache.move_to_end(telegram_id)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def get(self, telegram_id):
+        # Возвращает (id, full_name, is_admin) или None, если пользователь не зарегистрирован
+        entry = self._cache.get(telegram_id)
+        if entry is not None:
+            self._cache.move_to_end(telegram_id)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        user = await self.db.get_user(telegram_id)
+        if user is None:
+            return None
+        entry = (user[0], user[1], telegram_id == self.admin_id)
+        self._put(telegram_id, entry)
+        return entry
+
+    async def preload(self, limit=None):
+        # Заполняет кэш недавно активными пользователями (при запуске бота)
+        rows = await self.db.recent_users(limit or self.maxsize)
+        for user_id, telegram_id, full_name in reversed(rows):
+            self._put(telegram_id, (user_id, full_name, telegram_id == self.admin_id))
+        return len(rows)
+
+    async def save(self, telegram_id, full_name, today):
+        user_id = await self.db.save_user(telegram_id, full_name, today)
+        self._put(telegram_id, (user_id, full_name, telegram_id == self.admin_id))
+        return user_id
+
+    async def delete(self, telegram_id):
+        self._cache.pop(telegram_id, None)
+        return await self.db.delete_user(telegram_id)
+
+    def invalidate(self, telegram_id=None):
+        # Без аргумента сбрасывает весь кэш (например, после очистки базы)
+        if telegram_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(telegram_id, None)
+
+    def stats(self):
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,101 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/webhook"
+# Сколько обновлений обрабатываем одновременно
+MAX_CONCURRENCY = 50
+# Максимальный размер тела запроса от Telegram
+MAX_BODY_SIZE = 1024 * 1024
+# Сколько секунд при остановке ждем обновления, которые еще обрабатываются
+SHUTDOWN_TIMEOUT = 60
+
+
+# Прием обновлений от Telegram через webhook на локальном aiohttp-сервере.
+# Обновление подтверждается сразу, а обрабатывается в фоне: долгий обработчик (выгрузка
+# за минуту и больше) иначе пережил бы таймаут Telegram, и тот прислал бы обновление повторно.
+# handle_in_background=False - для фронта, который только передает обновление воркеру:
+# ответ ждет передачи, и при ошибке Telegram получает 503 и присылает обновление снова.
+class WebhookServer:
+    def __init__(self, dp, bot, secret_token=None, path=WEBHOOK_PATH,
+                 max_concurrency=MAX_CONCURRENCY, max_body_size=MAX_BODY_SIZE, handle_in_background=True):
+        self.dp = dp
+        self.bot = bot
+        self.secret_token = secret_token
+        self.path = path
+        self.max_body_size = max_body_size
+        self.handle_in_background = handle_in_background
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._runner = None
+        self._tasks = set()
+
+    def create_app(self):
+        app = web.Application(client_max_size=self.max_body_size)
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    def _check_secret(self, request):
+        if not self.secret_token:
+            return True
+        received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        return hmac.compare_digest(received, self.secret_token)
+
+    async def handle(self, request):
+        if not self._check_secret(request):
+            logger.warning(f"Webhook: неверный секретный токен от {request.remote}")
+            return web.Response(status=401)
+        if request.content_length is not None and request.content_length > self.max_body_size:
+            return web.Response(status=413)
+        try:
+            payload = await request.json()
+            update = Update.model_validate(payload, context={"bot": self.bot})
+        except web.HTTPRequestEntityTooLarge:
+            return web.Response(status=413)
+        except Exception as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+
+        if not self.handle_in_background:
+            async with self._semaphore:
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                except Exception as e:
+                    logger.error(f"Не удалось передать обновление {update.update_id}: {e}")
+                    return web.Response(status=503)
+            return web.Response()
+
+        # Семафор берется до ответа: при перегрузке Telegram ждет, а не получает
+        # подтверждения для обновлений, которые некому обработать
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _feed(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+        finally:
+            self._semaphore.release()
+
+    async def start(self, host, port):
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        logger.info(f"Webhook-сервер слушает http://{host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            # Новые обновления уже не принимаются - даем начатым обработчикам завершиться
+            await asyncio.wait(self._tasks, timeout=SHUTDOWN_TIMEOUT)
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import socket
+
+from aiogram.types import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Лимит строки протокола (одно обновление)
+LINE_LIMIT = 1024 * 1024
+# Long polling на фронте: сколько секунд Telegram держит запрос getUpdates
+POLLING_TIMEOUT = 10
+# Пауза перед перезапуском упавшего воркера; растет, если воркер не запускается
+RESTART_DELAY = 1.0
+RESTART_MAX_DELAY = 30.0
+
+# Режим нескольких процессов. Фронт принимает обновления (polling или webhook) и раздает их
+# воркерам по from_user.id, по одному JSON-сообщению на строку:
+#   фронт -> воркер: {"update": {...}} или {"control": "invalidate"}
+#   воркер -> фронт: {"broadcast": "invalidate"} - фронт пересылает команду остальным воркерам
+# Канал с каждым воркером - пара сокетов (socketpair), второй конец которой воркер получает
+# при запуске. Слушающего порта нет: подключиться к воркеру или подделать обновление
+# "от администратора" другой процесс не может.
+# Все обновления пользователя попадают в один воркер, поэтому его FSM, кэш и ограничитель
+# частоты живут в одном процессе.
+
+
+def shard_key(update):
+    # Пользователь, от которого пришло обновление (для служебных обновлений - 0)
+    try:
+        user = getattr(update.event, "from_user", None)
+    except Exception:
+        user = None
+    return user.id if user is not None else 0
+
+
+def _encode(message):
+    return json.dumps(message, ensure_ascii=False).encode() + b"\n"
+
+
+# Фронт: соединения со всеми воркерами. Совместим с Dispatcher по методу feed_update,
+# поэтому WebhookServer передает обновления в воркеры без изменений.
+# spawn(index, sock) запускает процесс воркера с его концом канала; упавший воркер
+# запускается заново, а пока его нет, обновления его пользователей не принимаются.
+class ShardRouter:
+    def __init__(self, workers, spawn):
+        self.workers = workers
+        self.spawn = spawn
+        self._processes = [None] * workers
+        self._writers = [None] * workers
+        self._listeners = [None] * workers
+        self._closing = False
+
+    async def start(self):
+        for index in range(self.workers):
+            await self._start_worker(index)
+        logger.info(f"Фронт подключен к воркерам: {self.workers}")
+
+    async def _start_worker(self, index):
+        front, child = socket.socketpair()
+        try:
+            self._processes[index] = self.spawn(index, child)
+        except Exception:
+            front.close()
+            raise
+        finally:
+            # Конец воркера фронту не нужен, иначе фронт не заметил бы его завершения
+            child.close()
+        reader, writer = await asyncio.open_connection(sock=front, limit=LINE_LIMIT)
+        self._writers[index] = writer
+        self._listeners[index] = asyncio.create_task(self._listen(index, reader))
+
+    async def _restart_worker(self, index):
+        self._writers[index].close()
+        self._writers[index] = None
+        process = self._processes[index]
+        await asyncio.to_thread(process.join)
+        logger.warning(f"Воркер {index} завершился (код {process.exitcode}), перезапуск")
+        delay = RESTART_DELAY
+        while not self._closing:
+            metrics.WORKER_RESTARTS.inc(worker=index)
+            await asyncio.sleep(delay)
+            try:
+                await self._start_worker(index)
+                return
+            except Exception as e:
+                logger.error(f"Не удалось запустить воркер {index}: {e}", exc_info=True)
+                delay = min(delay * 2, RESTART_MAX_DELAY)
+
+    async def feed_update(self, bot, update):
+        index = shard_key(update) % self.workers
+        writer = self._writers[index]
+        if writer is None or writer.is_closing():
+            # Ошибка вместо подтверждения: Telegram пришлет обновление еще раз
+            raise ConnectionError(f"Воркер {index} недоступен")
+        payload = update.model_dump_json(exclude_none=True, by_alias=True)
+        writer.write(b'{"update": ' + payload.encode() + b"}\n")
+        # Если воркер не успевает, фронт перестает читать новые обновления
+        await writer.drain()
+        metrics.SHARD_UPDATES.inc(worker=index)
+
+    async def broadcast(self, command, exclude=None):
+        for index, writer in enumerate(self._writers):
+            if index != exclude and writer is not None and not writer.is_closing():
+                writer.write(_encode({"control": command}))
+                await writer.drain()
+
+    async def _listen(self, index, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                line = b""
+            if not line:
+                break
+            try:
+                command = json.loads(line)["broadcast"]
+                await self.broadcast(command, exclude=index)
+            except Exception as e:
+                logger.error(f"Некорректное сообщение от воркера {index}: {e}")
+        if not self._closing:
+            await self._restart_worker(index)
+
+    async def close(self):
+        # Воркеры завершаются, когда фронт закрывает каналы
+        self._closing = True
+        for task in self._listeners:
+            if task is not None:
+                task.cancel()
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()
+        for process in self._processes:
+            if process is not None:
+                await asyncio.to_thread(process.join)
+        self._writers = [None] * self.workers
+        self._listeners = [None] * self.workers
+        self._processes = [None] * self.workers
+
+
+async def poll_updates(bot, router, timeout=POLLING_TIMEOUT):
+    # Long polling на фронте: обновления не обрабатываются здесь, а раздаются воркерам
+    offset = None
+    delay = 1.0
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=timeout, request_timeout=int(bot.session.timeout + timeout))
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+            continue
+        delay = 1.0
+        for update in updates:
+            try:
+                await router.feed_update(bot, update)
+            except Exception as e:
+                # Воркер перезапускается: обновление и следующие за ним запросим снова
+                logger.error(f"Не удалось передать обновление {update.update_id}: {e}")
+                await asyncio.sleep(RESTART_DELAY)
+                break
+            offset = update.update_id + 1
+
+
+# Воркер: принимает обновления от фронта и передает их в диспетчер
+class WorkerServer:
+    def __init__(self, dp, bot, on_control=None, max_concurrency=50):
+        self.dp = dp
+        self.bot = bot
+        self.on_control = on_control
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._reader_task = None
+        self._front = None
+        self._tasks = set()
+        self._disconnected = asyncio.Event()
+
+    async def start(self, sock):
+        # sock - конец канала, полученный от фронта; других подключений у воркера нет
+        reader, writer = await asyncio.open_connection(sock=sock, limit=LINE_LIMIT)
+        self._front = writer
+        self._reader_task = asyncio.create_task(self._handle(reader, writer))
+        logger.info("Воркер подключен к фронту")
+
+    async def wait_closed(self):
+        # Воркер работает, пока подключен фронт
+        await self._disconnected.wait()
+
+    async def broadcast(self, command):
+        # Команда для остальных воркеров (например, сбросить кэши после очистки базы)
+        if self._front is not None:
+            self._front.write(_encode({"broadcast": command}))
+            await self._front.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "control" in message:
+                    if self.on_control is not None:
+                        await self.on_control(message["control"])
+                    continue
+                update = Update.model_validate(message["update"], context={"bot": self.bot})
+                # Семафор берется до создания задачи: при перегрузке воркер перестает читать сокет
+                await self._semaphore.acquire()
+                task = asyncio.create_task(self._feed(update))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except Exception as e:
+            logger.error(f"Ошибка соединения с фронтом: {e}", exc_info=True)
+        finally:
+            writer.close()
+            self._front = None
+            self._disconnected.set()
+
+    async def _feed(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+        finally:
+            self._semaphore.release()
+
+    async def stop(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None